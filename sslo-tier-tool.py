@@ -1,4 +1,4 @@
-#!/usr/bin/python2.7
+#!/usr/bin/env python3
 
 #### SSL Orchestrator External Tiered Architecture Helper Utility #########
 #### Author: Kevin Stewart, Sr. SSA, F5 Networks
@@ -9,10 +9,12 @@
 ####    "sslo-side" (SSLO-to-LTM) and "svc-side" (LTM-to-services) VLANs, self-IPs, pools, VIPs, rules, etc. SSLO service configurations 
 ####    need only define a single device that is the sslo-side interface of this BIG-IP LTM. The LTM then handles traffic distribution
 ####    to the respective security devices. Configuration state for each security service is maintained in YAML source-of-truth files.
-####    Note that updating a security service configuration is a volatile action that may interrupt traffic (momentarily).
+####    Updates are incremental: the objects on the BIG-IP are compared with the YAML and only the differences are applied. A full
+####    (traffic interrupting) delete and rebuild of the service can still be forced with the "--rebuild" option.
 ####
 #### Instructions: execute the command with a "--file" option followed by the name of a service configuration YAML file
-####    ex. python sslo-tier-tool.py --file icapservice1.yml
+####    ex. python3 sslo-tier-tool.py --file icapservice1.yml
+####    Requires Python 3.9 or later, with the requests and PyYAML packages (aiohttp is optional, for --transport async).
 ####
 ####    Please refer to (https://github.com/kevingstewart/sslo-external-layered-architecture) for detailed information on the use of this tool and service configuration YAML syntax.
 
@@ -20,7 +22,13 @@
 ## Imports
 from yaml import load, safe_load, dump
 from argparse import ArgumentParser
-import sys, json, requests, time, logging, random
+import sys, os, re, json, requests, time, logging, threading, hashlib, atexit, base64
+from concurrent.futures import ThreadPoolExecutor
+
+## asyncio and the optional aiohttp client are only imported when the async transport is used (they add noticeably to the
+## start-up time of every run otherwise)
+asyncio = None
+aiohttp = None
 
 
 ## Disable certificate warnings
@@ -34,895 +42,1734 @@ logging.basicConfig(filename='/var/log/sslo.log', encoding='utf-8', level=loggin
 
 ## Set global variables
 global configs
+global rebuild
+global plan
+plan = False
 
 
 ## error routine
 def error_exit(msg):
     print(msg)
     print("\nExiting\n\n")
-    sys.exit()
-
-
-## create sslo-tier-datagroup (mapping table)
-def sslo_datagroup(user, password, host):    
-    s = requests.session()
-    s.auth = (user, password)
-    s.verify = False
-    s.headers.update({'Content-Type':'application/json'})
-    resp = s.get("https://" + host + "/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup").json()
-    if "selfLink" not in resp:
+    sys.exit(1)
+
+
+## progress output - a single write per line so that concurrent service handlers don't interleave partial lines. Batch
+## runs set a per-thread prefix (the file name) so that each line can be attributed to its file
+output_lock = threading.Lock()
+output = threading.local()
+
+def report(msg):
+    with output_lock:
+        sys.stdout.write(getattr(output, "prefix", "") + str(msg) + "\n")
+        sys.stdout.flush()
+
+
+## service configuration or deployment error - raised by the handlers so that batch runs can report it per file
+class ServiceError(Exception):
+    pass
+
+
+## iControl REST client settings (overridden from the command line) - concurrency is the number of requests in flight per BIG-IP
+client_options = {"timeout":30, "connect_timeout":10, "concurrency":8, "transport":"requests"}
+
+## single mapping record edits from the command line ("service:srcmac" -> destip to add or change, "service:srcmac" to remove)
+mapping_edits = {"add":{}, "remove":[]}
+
+## shared clients, one per BIG-IP and user for the whole run
+clients = {}
+clients_lock = threading.Lock()
+
+## desired object sets collected instead of applied - the HA mode builds the object sets of both units before changing either
+collector = threading.local()
+
+
+## response of the async transport - the subset of a requests response the client uses
+class AsyncResponse(object):
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+## asynchronous transport (--transport async) - the requests of every client are multiplexed on one event loop running in a
+## background thread, with at most "concurrency" requests in flight per BIG-IP. Requests are sent with aiohttp when it is
+## installed, otherwise with the client's requests session in the loop's worker threads
+class AsyncTransport(object):
+    loop = None
+    loop_lock = threading.Lock()
+    transports = []
+
+    def __init__(self, session, concurrency):
+        self.session = session
+        self.concurrency = concurrency
+        self.http = None
+        self.slots = None
+        self.loop = AsyncTransport.event_loop()
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+        AsyncTransport.transports.append(self)
+
+    ## the shared event loop, started on first use
+    @classmethod
+    def event_loop(cls):
+        global asyncio, aiohttp
+        with cls.loop_lock:
+            if cls.loop is None:
+                import asyncio
+                try:
+                    import aiohttp
+                except ImportError:
+                    aiohttp = None
+                cls.loop = asyncio.new_event_loop()
+                cls.loop.set_default_executor(ThreadPoolExecutor(max_workers=32))
+                threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+                atexit.register(cls.shutdown)
+            return cls.loop
+
+    ## close the aiohttp sessions at exit
+    @classmethod
+    def shutdown(cls):
+        for x in cls.transports:
+            try:
+                asyncio.run_coroutine_threadsafe(x._close(), cls.loop).result(5)
+            except Exception:
+                pass
+
+    async def _open(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        if aiohttp is not None:
+            self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False))
+
+    async def _close(self):
+        if self.http is not None:
+            await self.http.close()
+
+    async def _send(self, method, url, data, headers, timeout):
+        async with self.slots:
+            if self.http is None:
+                return await self.loop.run_in_executor(None, lambda: self.session.request(method, url, data=data, headers=headers, timeout=timeout))
+
+            ## session headers (content type, auth token) and basic auth are taken from the requests session
+            merged = dict(self.session.headers)
+            if self.session.auth:
+                merged["Authorization"] = "Basic " + base64.b64encode((self.session.auth[0] + ":" + self.session.auth[1]).encode("utf-8")).decode("ascii")
+            merged.update(headers)
+            try:
+                async with self.http.request(method, url, data=data, headers=merged, timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])) as resp:
+                    return AsyncResponse(resp.status, dict(resp.headers), await resp.read())
+            except asyncio.TimeoutError as e:
+                raise requests.exceptions.Timeout(str(e))
+            except aiohttp.ClientError as e:
+                raise requests.exceptions.ConnectionError(str(e))
+
+    ## queue a request on the event loop - returns a future of the response
+    def submit(self, method, url, data, headers, timeout):
+        return asyncio.run_coroutine_threadsafe(self._send(method, url, data, headers, timeout), self.loop)
+
+
+## iControl REST client - one keep-alive connection pool, auth token and discovery cache per BIG-IP
+class IControlClient(object):
+    ## number of objects requested per page when walking large collections
+    page_size = 500
+
+    ## size of each request of a file upload
+    chunk_size = 512 * 1024
+
+    def __init__(self, host, user, password):
+        self.host = host
+        self.user = user
+        self.password = password
+        ## host is a name or address (https), or a full URL (ex. http://127.0.0.1:8100 for the mock server in tools/)
+        self.base = host if "://" in host else "https://" + host
+        self.timeout = (client_options["connect_timeout"], client_options["timeout"])
+
+        ## keep-alive connection pool sized for the number of concurrent requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=client_options["concurrency"])
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = False
+        self.session.headers.update({'Content-Type':'application/json'})
+
+        ## requests in flight to this BIG-IP are limited to the concurrency setting, by the async transport or (requests
+        ## transport) by a semaphore shared by all threads using the client
+        self.transport = AsyncTransport(self.session, client_options["concurrency"]) if client_options["transport"] == "async" else None
+        self.slots = threading.BoundedSemaphore(client_options["concurrency"])
+
+        ## time taken by each request (seconds), for the latency summary of the fleet mode
+        self.latencies = []
+
+        ## discovery cache - collection -> {name: object} name index, each collection is fetched at most once per run
+        self.index = {}
+
+        ## run-once state shared by the service handlers (ex. data group and library rule checks, device facts)
+        self.prepared = False
+        self.device_facts = None
+
+        ## the client is shared by concurrent service handlers
+        self.lock = threading.RLock()
+        self.auth_lock = threading.Lock()
+
+        ## layer 2 services are allocated and applied one at a time, so two of them never pick the same free route domain/subnet
+        self.allocation_lock = threading.Lock()
+
+        self.login()
+
+    ## token authentication - the BIG-IP validates the password once instead of on every request (falls back to basic auth)
+    def login(self):
+        with self.auth_lock:
+            self._login()
+
+    def _login(self):
+        self.session.headers.pop("X-F5-Auth-Token", None)
+        self.session.auth = None
+        datastr = {"username":self.user, "password":self.password, "loginProviderName":"tmos"}
+        try:
+            resp = self.session.post(self.base + "/mgmt/shared/authn/login", data=json.dumps(datastr), timeout=self.timeout)
+            token = resp.json()["token"]["token"]
+            self.session.headers.update({"X-F5-Auth-Token":token})
+        except (ValueError, KeyError, TypeError, requests.exceptions.RequestException):
+            self.session.auth = (self.user, self.password)
+
+    ## send a request - path is relative to the BIG-IP (ex. /mgmt/tm/net/vlan), tx adds it to a transaction, content is sent
+    ## as is instead of a JSON payload (ex. file uploads)
+    def request(self, method, path, datastr=None, tx=None, content=None, headers=None):
+        headers = dict(headers or {})
+        if tx is not None:
+            headers["X-F5-REST-Coordination-Id"] = str(tx)
+        data = json.dumps(datastr) if datastr is not None else content
+        token = self.session.headers.get("X-F5-Auth-Token")
+        resp = self.send(method, path, data, headers)
+
+        ## expired token - log in again (unless another thread already did) and resend once
+        if resp.status_code == 401 and token is not None:
+            if token == self.session.headers.get("X-F5-Auth-Token"):
+                self.login()
+            resp = self.send(method, path, data, headers)
+        return resp
+
+    ## send one request on the transport of the client
+    def send(self, method, path, data, headers):
+        start = time.time()
+        try:
+            if self.transport is not None:
+                return self.transport.submit(method, self.base + path, data, headers, self.timeout).result()
+            with self.slots:
+                return self.session.request(method, self.base + path, data=data, headers=headers, timeout=self.timeout)
+        finally:
+            self.latencies.append(time.time() - start)
+
+    def get(self, path):
+        return self.request("GET", path).json()
+
+    ## GET several paths at once - the requests overlap (up to the concurrency setting), the bodies are returned in order
+    def get_many(self, paths):
+        if plan or len(paths) < 2:
+            return [self.get(x) for x in paths]
+        if self.transport is None:
+            with ThreadPoolExecutor(max_workers=min(len(paths), client_options["concurrency"])) as pool:
+                return list(pool.map(self.get, paths))
+
+        ## all requests are queued on the event loop first, an expired token is handled by sending the request again
+        token = self.session.headers.get("X-F5-Auth-Token")
+        futures = [self.transport.submit("GET", self.base + x, None, {}, self.timeout) for x in paths]
+        bodies = []
+        for path, future in zip(paths, futures):
+            resp = future.result()
+            if resp.status_code == 401 and token is not None:
+                resp = self.request("GET", path)
+            bodies.append(resp.json())
+        return bodies
+
+    def post(self, path, datastr, tx=None):
+        return self.request("POST", path, datastr, tx)
+
+    def patch(self, path, datastr, tx=None):
+        return self.request("PATCH", path, datastr, tx)
+
+    def delete(self, path, tx=None):
+        return self.request("DELETE", path, None, tx)
+
+    ## upload a file to /var/config/rest/downloads on the BIG-IP (in chunks, the file transfer worker takes at most 1MB per request)
+    def upload(self, filename, content):
+        data = content.encode("utf-8")
+        start = 0
+        while True:
+            end = min(start + self.chunk_size, len(data))
+            headers = {"Content-Type":"application/octet-stream", "Content-Range":str(start) + "-" + str(end - 1) + "/" + str(len(data))}
+            resp = self.request("POST", "/mgmt/shared/file-transfer/uploads/" + filename, content=data[start:end], headers=headers)
+            if resp.status_code >= 400:
+                raise ServiceError("Failed to upload " + filename + ": " + str(resp.status_code))
+            start = end
+            if start >= len(data):
+                return
+
+    ## download a file from /var/config/rest/downloads (the file transfer worker, no shell access needed) in chunks of
+    ## "Content-Range: start-end/size" - the size is learnt from the first response. Returns None if the file cannot be read
+    def download(self, filename):
+        data = b""
+        size = 0
+        while True:
+            end = len(data) + self.chunk_size if not size else min(len(data) + self.chunk_size, size)
+            headers = {"Content-Type":"application/octet-stream", "Content-Range":str(len(data)) + "-" + str(end - 1) + "/" + str(size)}
+            resp = self.request("GET", "/mgmt/shared/file-transfer/downloads/" + filename, headers=headers)
+            total = [v for k, v in resp.headers.items() if k.lower() == "content-range"]
+            total = total[0].split("/")[-1] if total else ""
+            if not total.isdigit():
+                ## the whole file, without ranges
+                return resp.content.decode("utf-8") if resp.status_code < 400 else None
+            if not size and int(total) > 0 and resp.status_code >= 400:
+                ## first chunk asked for more than the file holds - ask again, now that the size is known
+                size = int(total)
+                continue
+            if resp.status_code >= 400:
+                return None
+            size = int(total)
+            data += resp.content
+            if len(data) >= size:
+                return data.decode("utf-8")
+
+    ## start a transaction - returns the transaction id to pass with each request
+    def transaction(self):
+        return self.post("/mgmt/tm/transaction", {}).json()['transId']
+
+    ## commit a transaction - returns the response
+    def commit(self, tx):
+        return self.patch("/mgmt/tm/transaction/{}".format(tx), {"state":"VALIDATING"})
+
+    ## fetch the name index of a collection - only name/fullPath/generation of /Common objects is returned, paged with $top/$skip
+    def discover(self, path):
+        with self.lock:
+            if path not in self.index:
+                self.index[path] = self._discover(path)
+            return self.index[path]
+
+    ## fetch the name indexes of several collections - the first pages are requested together
+    def discover_many(self, paths):
+        with self.lock:
+            missing = [x for x in paths if x not in self.index]
+            for path, body in zip(missing, self.get_many([x + self.discover_query(x, 0) for x in missing])):
+                self.index[path] = self._discover(path, body)
+
+    def discover_query(self, path, skip):
+        select = "name,fullPath,generation"
+        ## pools also list their monitors, so that the monitor collections a service uses are known without listing them all
+        if path == "/mgmt/tm/ltm/pool":
+            select += ",monitor"
+        return "?$select=" + select + "&$filter=partition%20eq%20Common&$top=" + str(self.page_size) + "&$skip=" + str(skip)
+
+    ## fetch every object of a collection (all partitions) with the given properties, paged with $top/$skip - expand also
+    ## returns subcollections (ex. pool members as membersReference)
+    def collection(self, path, select, expand=False):
+        items = []
+        skip = 0
+        while True:
+            query = "?$select=" + select + "&$top=" + str(self.page_size) + "&$skip=" + str(skip)
+            if expand:
+                query += "&expandSubcollections=true"
+            page = self.get(path + query).get("items", [])
+            items += page
+            if len(page) < self.page_size:
+                return items
+            skip += self.page_size
+
+    def _discover(self, path, first=None):
+
+        index = {}
+        skip = 0
+        while True:
+            if skip == 0 and first is not None:
+                items = first.get("items", [])
+            else:
+                items = self.get(path + self.discover_query(path, skip)).get("items", [])
+            for j in items:
+                index[j["name"]] = j
+            if len(items) < self.page_size:
+                break
+            skip += self.page_size
+        return index
+
+    ## list a service's objects (collection, name) from the discovery name index. Of the monitor collections, only the ones
+    ## given (the collections of the desired monitors, listed together with the other collections) and the ones of the
+    ## monitors still attached to the service's pools (ex. a monitor type no longer desired, or a service being deleted) are
+    ## listed
+    def discover_service(self, name, monitors=(), devices=()):
+        collections = [x for x in managed_collections if x not in reference_properties["monitor"] or x in monitors]
+        self.discover_many(collections)
+        devices = self.service_devices(name, devices)
+        attached = set(monitors)
+        for objname, pool in self.discover("/mgmt/tm/ltm/pool").items():
+            if service_owns(objname, name, devices):
+                for token in str(pool.get("monitor", "")).split():
+                    attached.add(monitor_collection(normalize_value(token), name))
+        collections = [x for x in managed_collections if x not in reference_properties["monitor"] or x in attached]
+        self.discover_many(collections)
+
+        found = []
+        for path in collections:
+            for objname in self.discover(path):
+                if service_owns(objname, name, devices):
+                    found.append((path, objname))
+        return found
+
+    ## device names of a (layer 2) service - the given ones (of its desired objects) and the ones of its route domains on the
+    ## BIG-IP ("svc-<name>-<device>-svc-rd"), except where a longer service name exists on the BIG-IP as well (ex. with a
+    ## service "fe-2", "svc-fe-2-DEV-svc-rd" is device "DEV" of that service, not device "2-DEV" of service "fe")
+    def service_devices(self, name, devices=()):
+        prefix = "svc-" + name + "-"
+        self.discover_many([x for x in managed_collections if x not in reference_properties["monitor"]])
+        names = set()
+        with self.lock:
+            for path in self.index:
+                names.update(self.index[path])
+        found = set(str(x) for x in devices)
+        for objname in self.discover("/mgmt/tm/net/route-domain"):
+            if not objname.startswith(prefix) or not objname.endswith("-svc-rd"):
+                continue
+            parts = objname[len(prefix):-len("-svc-rd")].split("-")
+            other = ["-".join(parts[:k]) for k in range(1, len(parts))]
+            if not any(prefix + p + "-" + x in names for p in other for x in service_suffixes):
+                found.add("-".join(parts))
+        return found
+
+    ## keep the discovery name index in step with a committed transaction (created or modified names added without a
+    ## generation, pools with the monitors of their payload, deleted names removed)
+    def discovery_update(self, created, deleted, payloads=None):
+        with self.lock:
+            self._discovery_update(created, deleted, payloads)
+
+    def _discovery_update(self, created, deleted, payloads=None):
+        for path, objname in created:
+            if path in self.index:
+                self.index[path][objname] = {"name":objname, "fullPath":"/Common/" + objname}
+                if "monitor" in (payloads or {}).get((path, objname), {}):
+                    self.index[path][objname]["monitor"] = payloads[(path, objname)]["monitor"]
+        for path, objname in deleted:
+            if path in self.index:
+                self.index[path].pop(objname, None)
+
+    ## forget the cached name index (ex. before re-enumerating after a failed transaction)
+    def discovery_forget(self):
+        with self.lock:
+            self.index = {}
+
+    ## fetch the name index of a collection again (ex. for the generations of the objects just changed)
+    def discovery_refresh(self, path):
+        with self.lock:
+            self.index[path] = self._discover(path)
+
+    ## device facts - failover state, device name, traffic groups and sync group, collected once per run so that every handler
+    ## works with the same view of the HA state
+    def facts(self):
+        with self.lock:
+            if self.device_facts is None:
+                self.device_facts = self._facts()
+            return self.device_facts
+
+    def _facts(self):
+        facts = {"failover":"ACTIVE", "device":None, "traffic_groups":{}, "sync_group":None}
+        failover, devices, traffic_groups, device_groups = self.get_many(["/mgmt/tm/cm/failover-status", "/mgmt/tm/cm/device?$select=name,selfDevice", "/mgmt/tm/cm/traffic-group/stats", "/mgmt/tm/cm/device-group?$select=name,type"])
+
+        ## failover state of this unit (ACTIVE, STANDBY, ...)
+        for entry in failover.get("entries", {}).values():
+            facts["failover"] = entry["nestedStats"]["entries"]["status"]["description"]
+
+        ## name of this device
+        for x in devices.get("items", []):
+            if str(x.get("selfDevice")) == "true":
+                facts["device"] = x["name"]
+
+        ## traffic groups and their state on this device (active, standby)
+        for entry in traffic_groups.get("entries", {}).values():
+            stats = entry.get("nestedStats", {}).get("entries", {})
+            if stats.get("deviceName", {}).get("description", "").split("/")[-1] == facts["device"]:
+                facts["traffic_groups"][stats["trafficGroup"]["description"].split("/")[-1]] = stats["failoverState"]["description"]
+
+        ## sync-failover device group (None on a standalone device)
+        for x in device_groups.get("items", []):
+            if x.get("type") == "sync-failover":
+                facts["sync_group"] = x["name"]
+        return facts
+
+
+## canned response for the offline plan client
+class PlanResponse(object):
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+## offline client for --plan - nothing is sent to the BIG-IP, every change is printed instead. The BIG-IP is treated as
+## empty (so the plan is the full build of each service) and as the active unit of an HA pair
+class PlanClient(IControlClient):
+
+    def __init__(self, host, user, password):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.base = host if "://" in host else "https://" + host
+        self.index = {}
+        self.prepared = False
+        self.device_facts = None
+        self.lock = threading.RLock()
+        self.allocation_lock = threading.Lock()
+        self.transactions = 0
+        self.latencies = []
+
+    def request(self, method, path, datastr=None, tx=None, content=None, headers=None):
+        if method == "GET":
+            if path.startswith("/mgmt/tm/cm/failover-status"):
+                return PlanResponse({"entries":{"https://localhost/mgmt/tm/cm/failover-status/0":{"nestedStats":{"entries":{"status":{"description":"ACTIVE"}}}}}})
+            return PlanResponse({})
+
+        if path == "/mgmt/tm/transaction":
+            self.transactions += 1
+            body = {"transId":self.transactions}
+        elif path.startswith("/mgmt/tm/transaction/"):
+            body = {"state":"PLANNED"}
+        else:
+            body = {}
+
+        ## one line per operation - keys sorted so that plans can be diffed and cached
+        line = method + " " + self.base + path
+        if tx is not None:
+            line += " [transaction " + str(tx) + "]"
+        if datastr is not None:
+            line += " " + json.dumps(datastr, sort_keys=True)
+        if content is not None:
+            line += " " + json.dumps(content.decode("utf-8"))
+        report(line)
+        return PlanResponse(body)
+
+
+## get the shared client for a BIG-IP
+def get_client(host, user, password):
+    with clients_lock:
+        if (host, user) not in clients:
+            if plan:
+                clients[(host, user)] = PlanClient(host, user, password)
+            else:
+                clients[(host, user)] = IControlClient(host, user, password)
+        return clients[(host, user)]
+
+
+## local state cache (--state) - what the tool last deployed to each BIG-IP: per service, the hash of the desired object set
+## and the generation of each object after it was applied. A service whose YAML is unchanged, and whose objects still
+## carry the same generations in the discovery name index (nobody has changed them since), is skipped without reading
+## any object
+class StateCache(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename, "r") as file:
+                self.services = json.load(file)["services"]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            self.services = {}
+
+    ## hash of a desired object set (independent of the order the objects were built in)
+    @staticmethod
+    def digest(desired):
+        payloads = sorted(path + " " + json.dumps(datastr, sort_keys=True) for path, datastr in desired)
+        return hashlib.sha256("\n".join(payloads).encode("utf-8")).hexdigest()
+
+    ## test if a service is exactly as it was last deployed - same desired objects, same set of objects on the BIG-IP,
+    ## and none of them modified since
+    def verify(self, client, name, digest):
+        with self.lock:
+            entry = self.services.get(client.host + " " + name)
+        if entry is None or entry["hash"] != digest:
+            return False
+        found = client.discover_service(name)
+        if sorted(key[0] + "/" + key[1] for key in found) != sorted(entry["objects"]):
+            return False
+        for key in found:
+            generation = client.discover(key[0])[key[1]].get("generation")
+            if generation is None or generation != entry["objects"][key[0] + "/" + key[1]]:
+                return False
+        return True
+
+    ## record a service as deployed - the generations of objects created or modified by this run are fetched again first
+    def record(self, client, name, digest):
+        found = client.discover_service(name)
+        for path in sorted(set(key[0] for key in found if client.discover(key[0])[key[1]].get("generation") is None)):
+            client.discovery_refresh(path)
+        objects = {}
+        for key in found:
+            objects[key[0] + "/" + key[1]] = client.discover(key[0]).get(key[1], {}).get("generation")
+        with self.lock:
+            self.services[client.host + " " + name] = {"hash":digest, "objects":objects, "updated":time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.save()
+
+    ## drop a service (removed, or left in an unknown state by a failed transaction)
+    def forget(self, client, name):
+        with self.lock:
+            if self.services.pop(client.host + " " + name, None) is not None:
+                self.save()
+
+    ## write the cache (to a temporary file first, so an interrupted run never leaves a truncated cache behind)
+    def save(self):
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump({"services":self.services}, file, indent=2, sort_keys=True)
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+## the state cache of this run (None unless --state is used)
+state_cache = None
+
+
+## create sslo-tier-datagroup (mapping table) - an internal data group, unless the mapping has been published as an external one
+def sslo_datagroup(client):
+    resp = client.get("/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup")
+    if "selfLink" not in resp and "selfLink" not in client.get("/mgmt/tm/ltm/data-group/external/sslo-tier-datagroup"):
         datastr = {"name":"sslo-tier-datagroup","type":"string"}
-        s.post("https://" + host + "/mgmt/tm/ltm/data-group/internal", data=json.dumps(datastr))
-
-
-## create library rule
-def sslo_library_rule(user, password, host):    
-    s = requests.session()
-    s.auth = (user, password)
-    s.verify = False
-    s.headers.update({'Content-Type':'application/json'})
-    resp = s.get("https://" + host + "/mgmt/tm/ltm/rule/sslo-tier-library").json()
-    if "selfLink" not in resp:
-        #datastr = {"name":"sslo-tier-library","apiAnonymous":"proc set_data { service } { table set \"${service}_[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" [LINK::lasthop] 10 }\nproc get_data { service } { set tuple \"${service}_[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" ; if { ${tuple} contains \"%\" } { set filter [findstr ${tuple} \"%\" 1 \":\"] ; set tuple [string map [list \"%${filter}\" \"\"] ${tuple}] } ; if { [set flowkey [class lookup \"${service}:[table lookup ${tuple}]\" sslo-tier-datagroup]] ne \"\" } { return ${flowkey} }}"}
-        datastr = {"name":"sslo-tier-librayr","apiAnonymous":"proc set_data { service value } { table set \"${service}_${value}\" [LINK::lasthop] 10 }\nproc get_data { service value } { set tuple \"${service}_${value}\" ; if { ${tuple} contains \"%\" } { set filter [findstr ${tuple} \"%\" 1 \":\"] ; set tuple [string map [list \"%${filter}\" \"\"] ${tuple}] } ; if { [set flowkey [class lookup \"${service}:[table lookup ${tuple}]\" sslo-tier-datagroup]] ne \"\" } { return ${flowkey} }}"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
+        client.post("/mgmt/tm/ltm/data-group/internal", datastr)
 
 
-## reset/delete objects procedure
-def reset_objects(host, user, password, name):
-    ## set number of iterations (number of times to try to delete objects - transactions will otherwise fail if objects exist)
-    itertask = 5
+## library rule code - get_data strips a route domain suffix from the flow tuple, get_data_fast (optimized library variant) is
+## for services whose tuples never carry one and looks the flow up directly. The *_subtable procs keep a service's flows in
+## its own session subtable (sslo-tier-<service>), the entry timeout and lifetime are passed by the service rule
+#sslo_library_code = "proc set_data { service } { table set \"${service}_[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" [LINK::lasthop] 10 }\nproc get_data { service } { set tuple \"${service}_[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" ; if { ${tuple} contains \"%\" } { set filter [findstr ${tuple} \"%\" 1 \":\"] ; set tuple [string map [list \"%${filter}\" \"\"] ${tuple}] } ; if { [set flowkey [class lookup \"${service}:[table lookup ${tuple}]\" sslo-tier-datagroup]] ne \"\" } { return ${flowkey} }}"
+sslo_library_code = "proc set_data { service value {timeout 10} {lifetime indefinite} } { table set \"${service}_${value}\" [LINK::lasthop] ${timeout} ${lifetime} }\nproc get_data { service value } { set tuple \"${service}_${value}\" ; if { ${tuple} contains \"%\" } { set filter [findstr ${tuple} \"%\" 1 \":\"] ; set tuple [string map [list \"%${filter}\" \"\"] ${tuple}] } ; if { [set flowkey [class lookup \"${service}:[table lookup ${tuple}]\" sslo-tier-datagroup]] ne \"\" } { return ${flowkey} }}\nproc get_data_fast { service value } { return [class lookup \"${service}:[table lookup \"${service}_${value}\"]\" sslo-tier-datagroup] }\nproc set_data_subtable { service value {timeout 10} {lifetime indefinite} } { table set -subtable \"sslo-tier-${service}\" ${value} [LINK::lasthop] ${timeout} ${lifetime} }\nproc get_data_subtable { service value } { return [class lookup \"${service}:[table lookup -subtable \"sslo-tier-${service}\" ${value}]\" sslo-tier-datagroup] }"
 
-    ## set number of seconds to pause after deleting an object (might be useful to tweak for BIG-IPs under heavy load)
-    pause = 1
-    
-    s = requests.session()
-    s.auth = (user, password)
-    s.verify = False
-    s.headers.update({'Content-Type':'application/json'})
-
-    ## virtual servers
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/ltm/virtual").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/ltm/virtual/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## pools
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/ltm/pool").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/ltm/pool/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## snatpools
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/ltm/snatpool").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/ltm/snatpool/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## monitors
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## rules
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/ltm/rule").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/ltm/rule/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## self-ips
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/net/self").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/net/self/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## vlans
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/net/vlan").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/net/vlan/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-    ## route-domains
-    counter = 1
-    while counter < itertask:
-        resp = s.get("https://" + host + "/mgmt/tm/net/route-domain").json()
-        obj_exists = 0
-        for j in resp["items"]:
-            if "svc-" + name + "-" in j["name"]:
-                obj_exists = 1
-                s.delete("https://" + host + "/mgmt/tm/net/route-domain/" + j["name"])
-        if not obj_exists:
-            break
-        time.sleep(pause)
-        counter += 1
-
-
-## layer 3 service procedures
-def service_layer3(configs):
-    ## state value
-    if "state" in configs["service"].keys():
-        state = configs["service"]["state"]
-    else:
-        state = "present"
 
-    ## name value
-    if "name" in configs["service"].keys():
-        name = configs["service"]["name"]
-    else:
-        error_exit("No service name supplied in YAML")
-
-    ## host value
-    if "host" in configs.keys():
-        host = configs["host"]
-    else:
-        error_exit("No host name supplied in YAML")
-
-    ## user value
-    if "user" in configs.keys():
-        user = configs["user"]
-    else:
-        error_exit("No username supplied in YAML")
-
-    ## password value
-    if "password" in configs.keys():
-        password = configs["password"]
+## create library rule - an existing library is updated when its code differs (ex. written by an older version of the tool)
+def sslo_library_rule(client):
+    resp = client.get("/mgmt/tm/ltm/rule/sslo-tier-library")
+    if "selfLink" not in resp:
+        datastr = {"name":"sslo-tier-library","apiAnonymous":sslo_library_code}
+        client.post("/mgmt/tm/ltm/rule", datastr)
+    elif " ".join(resp.get("apiAnonymous", "").split()) != " ".join(sslo_library_code.split()):
+        datastr = {"apiAnonymous":sslo_library_code}
+        client.patch("/mgmt/tm/ltm/rule/sslo-tier-library", datastr)
+
+
+## session table timeout and lifetime values of a service - the timeout in seconds (default 10), the lifetime in seconds or
+## "indefinite" (default)
+def table_values(service):
+    timeout = str(service.get("table-timeout", 10))
+    lifetime = str(service.get("table-lifetime", "indefinite"))
+    if not timeout.isdigit() or int(timeout) < 1:
+        raise ServiceError("Incorrect table-timeout value entered (seconds).")
+    if lifetime != "indefinite" and (not lifetime.isdigit() or int(lifetime) < 1):
+        raise ServiceError("Incorrect table-lifetime value entered (seconds or indefinite).")
+    return int(timeout), lifetime if lifetime == "indefinite" else int(lifetime)
+
+
+## library procs of a service - returns the proc its sslo-side rule records flows with, the proc its return-side rule looks
+## flows up with, and the session table timeout/lifetime arguments for the record proc (empty for the 10 second default)
+def service_library(configs):
+    if "library" in configs["service"].keys():
+        library = configs["service"]["library"]
     else:
-        error_exit("No password supplied in YAML")
-
-    ## process state
-    if state == "absent":
-        #### Delete named objects
-        print("Deleting Layer 3 Service Objects")
-
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-
-    elif state == "present":
-        #### Parse YAML values ####
-        print("Creating Layer 3 Service Objects")
-
-        ## sslo-side-net and svc-side-net base keys
-        if "sslo-side-net" in configs["service"].keys() and "svc-side-net" in configs["service"].keys():
-            pass
-        else:
-            error_exit("Missing sslo-side-net or svc-side-net keys.")
-
-        ## sslo-side-net values
-        if "entry-interface" in configs["service"]["sslo-side-net"].keys() and "entry-self" in configs["service"]["sslo-side-net"].keys() and "return-interface" in configs["service"]["sslo-side-net"].keys() and "return-self" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_interface = str(configs["service"]["sslo-side-net"]["entry-interface"])
-            sslo_side_net_entry_self = configs["service"]["sslo-side-net"]["entry-self"]
-            sslo_side_net_return_interface = str(configs["service"]["sslo-side-net"]["return-interface"])
-            sslo_side_net_return_self = configs["service"]["sslo-side-net"]["return-self"]
-        else:
-            error_exit("Missing entry and/or return sslo-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_tag = str(configs["service"]["sslo-side-net"]["entry-tag"])
-        else:
-            sslo_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_return_tag = str(configs["service"]["sslo-side-net"]["return-tag"])
-        else:
-            sslo_side_net_return_tag = "none"
-
-        ## svc-side-net values
-        if "entry-interface" in configs["service"]["svc-side-net"].keys() and "entry-self" in configs["service"]["svc-side-net"].keys() and "return-interface" in configs["service"]["svc-side-net"].keys() and "return-self" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_interface = str(configs["service"]["svc-side-net"]["entry-interface"])
-            svc_side_net_entry_self = configs["service"]["svc-side-net"]["entry-self"]
-            svc_side_net_return_interface = str(configs["service"]["svc-side-net"]["return-interface"])
-            svc_side_net_return_self = configs["service"]["svc-side-net"]["return-self"]
-        else:
-            error_exit("Missing entry and/or return svc-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_tag = str(configs["service"]["svc-side-net"]["entry-tag"])
-        else:
-            svc_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_return_tag = str(configs["service"]["svc-side-net"]["return-tag"])
-        else:
-            svc_side_net_return_tag = "none"
-        
-        ## svc-members values
-        if "svc-members" in configs["service"].keys():
-            mbrstr = []
-            for x in configs["service"]["svc-members"]:
-                mbrdict = {"name":"" + x + ":any","address":"" + x + ""}
-                mbrstr.append(mbrdict)
-        else:
-            error_exit("Missing svc-members key.")
-
-
-        #### Create or modify named objects ####
-        
-        ## make sure the data group exists
-        sslo_datagroup(user, password, host)
-
-        ## create the library iRules
-        sslo_library_rule(user, password, host)
-
-        ## create tmsh transaction to build network objects
-        s = requests.session()
-        s.auth = (user, password)
-        s.verify = False
-        s.headers.update({'Content-Type':'application/json'})
-
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-        ## make sure nodes don't exist
-        for x in configs["service"]["svc-members"]:
-            vals = x.split(":")
-            resp = s.get("https://" + host + "/mgmt/tm/node/" + vals[0] + "").json()
-            if "kind" in resp:
-                s.delete("https://" + host + "/mgmt/tm/node/" + vals[0] + "")
-
-        ## build transaction
-        tx = s.post("https://" + host + "/mgmt/tm/transaction", data=json.dumps({})).json()['transId']
-        s.headers.update({'X-F5-REST-Coordination-Id': str(tx)})
-
-        ## build objects - sslo-side entry vlan
-        if sslo_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-in","interfaces":"" + str(sslo_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-in","tag":"" + str(sslo_side_net_entry_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side return vlan
-        if sslo_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-out","interfaces":"" + str(sslo_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-out","tag":"" + str(sslo_side_net_return_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+        library = "standard"
+    if library not in ("standard", "optimized"):
+        raise ServiceError("Incorrect library value entered (standard or optimized).")
+
+    ## session table entry timeout (idle seconds, refreshed by every lookup) and lifetime (seconds, or indefinite)
+    table_args = ""
+    if "table-timeout" in configs["service"].keys() or "table-lifetime" in configs["service"].keys():
+        timeout, lifetime = table_values(configs["service"])
+        table_args = " " + str(timeout) + " " + str(lifetime)
+
+    ## per-service subtable - the lookup is always the direct one (layer 2 rules strip the route domain themselves)
+    if configs["service"].get("table-subtable", False) is True:
+        return "set_data_subtable", "get_data_subtable", table_args
+    elif library == "optimized":
+        return "set_data", "get_data_fast", table_args
+    return "set_data", "get_data", table_args
+
+
+## make sure the shared data group and library rule exist - checked once per BIG-IP per run, however many services are applied
+def sslo_prerequisites(client):
+    with client.lock:
+        if not client.prepared:
+            sslo_datagroup(client)
+            sslo_library_rule(client)
+            client.prepared = True
+
+
+## managed object collections, in creation (dependency) order - deletes are processed in reverse order
+managed_collections = [
+    "/mgmt/tm/net/vlan",
+    "/mgmt/tm/net/route-domain",
+    "/mgmt/tm/net/self",
+    "/mgmt/tm/ltm/monitor/gateway-icmp",
+    "/mgmt/tm/ltm/monitor/tcp-half-open",
+    "/mgmt/tm/ltm/monitor/tcp",
+    "/mgmt/tm/ltm/monitor/http",
+    "/mgmt/tm/ltm/monitor/inband",
+    "/mgmt/tm/ltm/pool",
+    "/mgmt/tm/ltm/snatpool",
+    "/mgmt/tm/ltm/rule",
+    "/mgmt/tm/ltm/virtual"
+]
+
+## object properties that point at other managed objects, and the collection the referenced object lives in (a pool monitor
+## may be of any of the monitor types)
+reference_properties = {
+    "vlan":"/mgmt/tm/net/vlan",
+    "vlans":"/mgmt/tm/net/vlan",
+    "monitor":["/mgmt/tm/ltm/monitor/gateway-icmp", "/mgmt/tm/ltm/monitor/tcp-half-open", "/mgmt/tm/ltm/monitor/tcp", "/mgmt/tm/ltm/monitor/http", "/mgmt/tm/ltm/monitor/inband"],
+    "pool":"/mgmt/tm/ltm/pool",
+    "rules":"/mgmt/tm/ltm/rule"
+}
+
+## properties the BIG-IP returns under a different name than the one the tool sends
+property_aliases = {"ip-protocol":"ipProtocol"}
+
+## properties that cannot be modified on an existing object - a change forces the object (and anything using it) to be replaced.
+## The monitor virtual is also rebuilt when its design changes (monitor-virtual), so nothing of the other design is left on it
+immutable_properties = {
+    "/mgmt/tm/net/route-domain":["id"],
+    "/mgmt/tm/net/self":["vlan", "address"],
+    "/mgmt/tm/ltm/virtual":["serviceDownImmediateAction"]
+}
+
+## properties a service sets only for some of its YAML values, and the value that clears them - an existing object that still
+## has another value is modified back to it when the desired payload no longer sets the property (ex. a monitor port or ICAP
+## SNAT removed from the YAML)
+property_resets = {
+    "/mgmt/tm/ltm/virtual":{"sourceAddressTranslation":{"type":"none"}},
+    "/mgmt/tm/ltm/monitor/tcp-half-open":{"destination":"*:*"},
+    "/mgmt/tm/ltm/monitor/tcp":{"destination":"*:*"},
+    "/mgmt/tm/ltm/monitor/http":{"destination":"*:*"}
+}
+
+## name suffixes of the objects built for a service - layer 2 per-device objects carry an extra "<device>-" before the suffix
+service_suffixes = ["sslo-side-in", "sslo-side-out", "sslo-side-in-float", "svc-side-in", "svc-side-out", "svc-side-in-float", "svc-side-out-float", "monitor", "tcp-half-open-monitor", "tcp-monitor", "http-monitor", "icap-monitor", "inband-monitor", "service-pool", "svc-pool", "snat-pool", "sslo-side-rule", "svc-side-rule", "monitor-rule", "sslo-side", "svc-side", "svc-in", "svc-in-rule"]
+device_suffixes = ["svc-in", "svc-out", "svc-out-float", "svc-rd", "svc-out-rule"]
+
+
+## test if an object name belongs to the named service - per-device objects only for the service's own device names (see
+## IControlClient.service_devices), as "svc-<name>-2-<device>-*" may just as well be a device of service "<name>-2"
+def service_owns(objname, name, devices=()):
+    prefix = "svc-" + name + "-"
+    if not objname.startswith(prefix):
+        return False
+    suffix = objname[len(prefix):]
+    if suffix in service_suffixes:
+        return True
+    for x in device_suffixes:
+        if suffix.endswith("-" + x) and suffix[:-len(x) - 1] in devices:
+            return True
+    return False
+
+
+## device names of a service's desired objects (from its per-device route domains)
+def desired_devices(name, desired):
+    prefix = "svc-" + name + "-"
+    return [x["name"][len(prefix):-len("-svc-rd")] for path, x in desired if path == "/mgmt/tm/net/route-domain" and x["name"].startswith(prefix) and x["name"].endswith("-svc-rd")]
+
+
+## test if a failed transaction is worth retrying, based on the error returned by the BIG-IP
+def retryable_error(status, message):
+    ## objects removed by someone else in the meantime - simply enumerate again
+    if "was not found" in message or "does not exist" in message:
+        return True
+    ## management plane busy (restjavad/mcpd) or another transaction holding the configuration
+    if status in (408, 429, 502, 503, 504) or "in progress" in message or "try again" in message.lower():
+        return True
+    return False
+
+
+## longest wait before retrying a transaction, whatever Retry-After asks for
+retry_delay_limit = 30
+
+
+## seconds to wait before retrying a transaction - Retry-After when it is given in seconds (its HTTP-date form and any other
+## value fall back to the attempt number), capped at retry_delay_limit
+def retry_delay(resp, attempt):
+    try:
+        delay = float(resp.headers.get("Retry-After", attempt))
+    except (TypeError, ValueError):
+        delay = attempt
+    if delay != delay or delay < 0:
+        delay = attempt
+    return min(delay, retry_delay_limit)
+
+
+## reset/delete objects procedure - removes every object of a service in a single transaction
+def reset_objects(client, name):
+    ## set maximum number of attempts (only errors the BIG-IP reports as transient are retried)
+    itertask = 5
 
-        ## svc-side entry vlan
-        if svc_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-in","interfaces":"" + str(svc_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-svc-side-in","tag":"" + str(svc_side_net_entry_tag) + "","interfaces":[{"name":"" + str(svc_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+    attempt = 1
+    while True:
+        ## enumerate the service's objects (name index only, one query per collection per run)
+        found = client.discover_service(name)
 
-        ## svc-side return vlan
-        if svc_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-out","interfaces":"" + str(svc_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-svc-side-out","tag":"" + str(svc_side_net_return_tag) + "","interfaces":[{"name":"" + str(svc_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side entry self
-        datastr = {"name":"svc-" + name + "-sslo-side-in","vlan":"svc-" + name + "-sslo-side-in","address":"" + sslo_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side return self
-        datastr = {"name":"svc-" + name + "-sslo-side-out","vlan":"svc-" + name + "-sslo-side-out","address":"" + sslo_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side entry float self
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-sslo-side-in-float","vlan":"svc-" + name + "-sslo-side-in","address":"" + configs["service"]["sslo-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry self
-        datastr = {"name":"svc-" + name + "-svc-side-in","vlan":"svc-" + name + "-svc-side-in","address":"" + svc_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return self
-        datastr = {"name":"svc-" + name + "-svc-side-out","vlan":"svc-" + name + "-svc-side-out","address":"" + svc_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry float self
-        if "entry-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-in-float","vlan":"svc-" + name + "-svc-side-in","address":"" + configs["service"]["svc-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return float self
-        if "return-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-out-float","vlan":"svc-" + name + "-svc-side-out","address":"" + configs["service"]["svc-side-net"]["return-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## monitor
-        datastr = {"name":"svc-" + name + "-monitor","interval":3,"timeout":7}
-        s.post("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp", data=json.dumps(datastr))
-
-        ## service pool
-        datastr = {"name":"svc-" + name + "-service-pool","monitor":"/Common/svc-" + name + "-monitor","members":mbrstr}
-        s.post("https://" + host + "/mgmt/tm/ltm/pool", data=json.dumps(datastr))
-
-        ## service rules
-        #datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" }"}
-        datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        #datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { node [call sslo-tier-library::get_data \"" + name + "\"] }"}
-        datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { catch { node [call sslo-tier-library::get_data \"" + name + "\" \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"] }}"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## monitor rule
-        datastr = {"name":"svc-" + name + "-monitor-rule","apiAnonymous":"when FLOW_INIT { if { [active_members svc-" + name + "-service-pool] < 1 } {drop} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## service virtuals
-        datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","pool":"svc-" + name + "-service-pool","profiles":"/Common/fastL4","rules":["svc-" + name + "-sslo-side-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        datastr = {"name":"svc-" + name + "-svc-side","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","profiles":"/Common/fastL4","rules":["svc-" + name + "-svc-side-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-svc-side-out"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## monitor virtual
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-float"].split("/")
-        else:
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-self"].split("/")
+        if not found:
+            if state_cache is not None:
+                state_cache.forget(client, name)
+            report("NO CHANGES")
+            return "NO CHANGES"
 
-        datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip[0] + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
+        ## build transaction - deletes ordered by dependency, users of an object are always deleted before the object itself
+        tx = client.transaction()
+        submit_layers(client, delete_layers(found), lambda key: client.delete(key[0] + "/" + key[1], tx))
 
         ## commit transaction
-        del s.headers['X-F5-REST-Coordination-Id']
-        result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()['state']
-        #result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()
-        print(result)
-
+        resp = client.commit(tx)
+        result = resp.json()
+        if result.get("state") == "COMPLETED":
+            client.discovery_update([], found)
+            if state_cache is not None:
+                state_cache.forget(client, name)
+            report(result["state"])
+            return result["state"]
+
+        message = str(result.get("message", result.get("state", "")))
+        if attempt >= itertask or not retryable_error(resp.status_code, message):
+            raise ServiceError("Failed to delete service objects: " + message)
+
+        ## back off only when the BIG-IP says it is busy (honoring Retry-After if sent)
+        if "was not found" not in message and "does not exist" not in message:
+            time.sleep(retry_delay(resp, attempt))
+        client.discovery_forget()
+        attempt += 1
+
+
+## normalize a scalar property value for comparison - strips the partition and the "any" port alias the BIG-IP returns differently
+def normalize_value(value):
+    value = str(value).strip()
+    if value.startswith("/Common/"):
+        value = value[8:]
+    if value.endswith(":any"):
+        value = value[:-4] + ":0"
+    return value
+
+
+## fetch a property from an object returned by the BIG-IP (expanded subcollections are returned as "<property>Reference")
+def lookup_property(obj, key):
+    if key not in obj:
+        key = property_aliases.get(key, key)
+    if key in obj:
+        return obj[key]
+    if key + "Reference" in obj:
+        return obj[key + "Reference"].get("items", [])
+    return None
+
+
+## compare a desired property value with the value on the BIG-IP - only the properties the tool sets are compared
+def values_match(want, have):
+    if isinstance(want, dict):
+        if not isinstance(have, dict):
+            return False
+        for key in want:
+            if not values_match(want[key], lookup_property(have, key)):
+                return False
+        return True
+
+    if isinstance(want, list) or isinstance(have, list):
+        if not isinstance(want, list):
+            want = [want]
+        ## an empty list is not returned by the BIG-IP at all (ex. a virtual without rules)
+        if not want and have is None:
+            return True
+        if not isinstance(have, list) or len(want) != len(have):
+            return False
+        for w in want:
+            w_name = normalize_value(w["name"]) if isinstance(w, dict) else normalize_value(w)
+            match = None
+            for h in have:
+                h_name = normalize_value(h["name"]) if isinstance(h, dict) else normalize_value(h)
+                if h_name == w_name:
+                    match = h
+                    break
+            if match is None:
+                return False
+            if isinstance(w, dict) and not values_match(w, match):
+                return False
+        return True
+
+    ## an empty string is not returned by the BIG-IP either (ex. a monitor without send or recv string)
+    if have is None:
+        return want == ""
+    return normalize_value(want) == normalize_value(have)
+
+
+## list the managed objects (collection, name) that an object refers to - works on desired payloads and BIG-IP objects alike
+def object_references(datastr):
+    refs = []
+    for key in datastr:
+        if key == "sourceAddressTranslation" and isinstance(datastr[key], dict) and "pool" in datastr[key]:
+            refs.append(("/mgmt/tm/ltm/snatpool", normalize_value(datastr[key]["pool"])))
+        elif key in reference_properties:
+            values = datastr[key] if isinstance(datastr[key], list) else [datastr[key]]
+            paths = reference_properties[key] if isinstance(reference_properties[key], list) else [reference_properties[key]]
+            for x in values:
+                for token in str(x).split():
+                    for path in paths:
+                        refs.append((path, normalize_value(token)))
+    return refs
+
+
+## list the objects of a set (collection, name) that an object must be created after - named references, route domains
+## used through an address suffix (ex. 198.18.1.1%10010/29) and pools named inside iRule code (ex. active_members)
+def object_dependencies(datastr, keys, route_domains):
+    deps = set()
+    for ref in object_references(datastr):
+        if ref in keys:
+            deps.add(ref)
+    for prop in ["address", "source", "destination"]:
+        if prop in datastr and "%" in str(datastr[prop]):
+            rd = re.match("[0-9]+", str(datastr[prop]).split("%")[1])
+            if rd and rd.group(0) in route_domains and route_domains[rd.group(0)] in keys:
+                deps.add(route_domains[rd.group(0)])
+    if "apiAnonymous" in datastr:
+        tokens = set(normalize_value(x) for x in re.split("[\\s\\[\\]{}\"]+", datastr["apiAnonymous"]) if x)
+        for key in keys:
+            if key[0] == "/mgmt/tm/ltm/pool" and key[1] in tokens:
+                deps.add(key)
+    return deps
+
+
+## split a set of objects into dependency layers - every object comes after everything it depends on, objects in the
+## same layer are independent of each other
+def dependency_layers(keys, dependencies):
+    rank = lambda key: managed_collections.index(key[0])
+    remaining = set(keys)
+    layers = []
+    while remaining:
+        layer = sorted([key for key in remaining if not (dependencies.get(key, set()) & remaining)], key=lambda key: (rank(key), key[1]))
+        if not layer:
+            raise ServiceError("Circular object dependency between: " + ", ".join(sorted(key[1] for key in remaining)))
+        layers.append(layer)
+        remaining -= set(layer)
+    return layers
+
+
+## delete layers - an object is only ever referenced by objects of a later collection, so one layer per collection, users first
+def delete_layers(keys):
+    layers = []
+    for path in reversed(managed_collections):
+        layer = sorted([key for key in keys if key[0] == path])
+        if layer:
+            layers.append(layer)
+    return layers
+
+
+## add operations to a transaction one layer at a time - the operations within a layer are sent concurrently, so the
+## time taken follows the depth of the dependency graph rather than the number of objects
+def submit_layers(client, layers, operation):
+    ## plans are printed in a fixed order
+    if plan:
+        for layer in layers:
+            for key in layer:
+                operation(key)
+        return
+    with ThreadPoolExecutor(max_workers=client_options["concurrency"]) as pool:
+        for layer in layers:
+            list(pool.map(operation, layer))
+
+
+## nodes in the way of new pool members - any node with a member's address (or named after it) is removed in the
+## transaction, so the BIG-IP creates it afresh for the member. Nodes still used by a pool other than the service's own are
+## kept. One bulk read of the node index (and of the pool members, only if a node is found) replaces a GET per member
+def conflicting_nodes(client, addresses, pools):
+    wanted = set(normalize_value(x) for x in addresses)
+    found = [x for x in client.collection("/mgmt/tm/ltm/node", "name,fullPath,address") if normalize_value(x.get("address", "")) in wanted or x["name"] in wanted]
+    if not found:
+        return []
+
+    ## node names and addresses used by the members of other pools
+    used = set()
+    for x in client.collection("/mgmt/tm/ltm/pool", "name,fullPath,membersReference", expand=True):
+        if x.get("fullPath", "/Common/" + x["name"]) in ["/Common/" + y for y in pools]:
+            continue
+        for member in lookup_property(x, "members") or []:
+            used.add(normalize_value(member.get("address", "")))
+            used.add(normalize_value(str(member["name"]).rsplit(":", 1)[0]))
+
+    nodes = []
+    for x in found:
+        if normalize_value(x.get("address", "")) not in used and normalize_value(x["name"]) not in used:
+            nodes.append("/mgmt/tm/ltm/node/" + x.get("fullPath", "/Common/" + x["name"]).replace("/", "~"))
+    return sorted(nodes)
+
+
+## reconcile a service's desired object set with the BIG-IP - only the objects that differ are created, modified or deleted.
+## scope limits the reconcile to part of the service (a test on the object key, used by the HA mode)
+def apply_objects(client, name, desired, scope=None):
+
+    ## object set requested by the HA mode - handed over instead of applied
+    if getattr(collector, "objects", None) is not None:
+        collector.objects.append((client, name, desired))
+        return "COLLECTED"
+
+    ## unchanged since the last run (state cache) - nothing to compare
+    cached = state_cache is not None and scope is None and not plan
+    if cached:
+        digest = state_cache.digest(desired)
+        if not rebuild and state_cache.verify(client, name, digest):
+            report("Unchanged since the last run (state cache)")
+            report("NO CHANGES")
+            return "NO CHANGES"
+
+    ## full rebuild requested - remove everything first, the reconcile below then simply creates the full object set
+    if rebuild and scope is None:
+        reset_objects(client, name)
+
+    ## index the desired objects
+    wanted = {}
+    for path, datastr in desired:
+        if scope is None or scope((path, datastr["name"])):
+            wanted[(path, datastr["name"])] = datastr
+
+    ## find the existing objects for this service from the name index - full bodies are only fetched for objects still
+    ## desired (to compare them), objects that are no longer desired only need their name to be deleted
+    current = {}
+    for key in client.discover_service(name, [key[0] for key in wanted if key[0] in reference_properties["monitor"]], desired_devices(name, desired)):
+        if scope is None or scope(key):
+            current[key] = {"name":key[1]}
+    compared = sorted(key for key in current if key in wanted)
+    for key, body in zip(compared, client.get_many([key[0] + "/" + key[1] + "?expandSubcollections=true" for key in compared])):
+        current[key] = body
+
+    ## properties no longer set by the desired payload are cleared on the BIG-IP
+    for key in compared:
+        for prop, value in property_resets.get(key[0], {}).items():
+            have = lookup_property(current[key], prop)
+            if prop not in wanted[key] and have is not None and not values_match(value, have):
+                wanted[key] = dict(wanted[key])
+                wanted[key][prop] = value
+
+    ## objects that need to be replaced (immutable property changed)
+    replaced = set()
+    for key in wanted:
+        if key in current:
+            for prop in immutable_properties.get(key[0], []):
+                if prop in wanted[key] and not values_match(wanted[key][prop], lookup_property(current[key], prop)):
+                    replaced.add(key)
+
+    ## anything on the BIG-IP that refers to a replaced object must also be removed first (and rebuilt if still desired) -
+    ## this needs the bodies of the objects that are no longer desired as well
+    if replaced:
+        unwanted = sorted(key for key in current if key not in wanted)
+        for key, body in zip(unwanted, client.get_many([key[0] + "/" + key[1] for key in unwanted])):
+            current[key] = body
+    changed = True
+    while changed:
+        changed = False
+        for key in current:
+            if key not in replaced:
+                for ref in object_references(current[key]):
+                    if ref in replaced:
+                        replaced.add(key)
+                        changed = True
+                        break
+
+    ## compute the operations
+    rank = lambda key: managed_collections.index(key[0])
+    replace_deletes = sorted([key for key in replaced if key in current], key=rank, reverse=True)
+    creates = sorted([key for key in wanted if key not in current or key in replaced], key=rank)
+    patches = sorted([key for key in wanted if key in current and key not in replaced and not values_match(wanted[key], current[key])], key=rank)
+    deletes = sorted([key for key in current if key not in wanted and key not in replaced], key=rank, reverse=True)
+
+    ## dependency graph of the objects to create (ex. self needs its vlan and route domain, virtual needs its pool and rules)
+    route_domains = {}
+    for key in wanted:
+        if key[0] == "/mgmt/tm/net/route-domain" and "id" in wanted[key]:
+            route_domains[str(wanted[key]["id"])] = key
+    dependencies = {}
+    for key in creates:
+        dependencies[key] = object_dependencies(wanted[key], creates, route_domains)
+    create_layers = dependency_layers(creates, dependencies)
+
+    if not (creates or patches or deletes or replace_deletes):
+        if cached:
+            state_cache.record(client, name, digest)
+        report("NO CHANGES")
+        return "NO CHANGES"
+    report("Changes: " + str(len(creates)) + " create, " + str(len(patches)) + " modify, " + str(len(deletes) + len(replace_deletes)) + " delete")
+
+    ## make sure nodes don't exist for newly added pool members (existing members keep their nodes)
+    added = []
+    for key in creates + patches:
+        if key[0] == "/mgmt/tm/ltm/pool" and "members" in wanted[key]:
+            existing = []
+            if key in current:
+                existing = [normalize_value(x.get("address", "")) for x in lookup_property(current[key], "members")]
+            for x in wanted[key]["members"]:
+                if normalize_value(x["address"]) not in existing and x["address"] not in added:
+                    added.append(x["address"])
+    node_deletes = conflicting_nodes(client, added, [key[1] for key in wanted if key[0] == "/mgmt/tm/ltm/pool"]) if added else []
+
+    ## build transaction - conflicting nodes and replaced objects are removed, then new objects are created layer by layer
+    ## (independent branches together), existing objects are modified and finally objects no longer desired are removed
+    tx = client.transaction()
+
+    def patch_object(key):
+        datastr = {}
+        for prop in wanted[key]:
+            if prop != "name" and prop not in immutable_properties.get(key[0], []):
+                datastr[prop] = wanted[key][prop]
+        return client.patch(key[0] + "/" + key[1], datastr, tx)
+
+    submit_layers(client, [node_deletes], lambda path: client.delete(path, tx))
+    submit_layers(client, delete_layers(replace_deletes), lambda key: client.delete(key[0] + "/" + key[1], tx))
+    submit_layers(client, create_layers, lambda key: client.post(key[0], wanted[key], tx))
+    submit_layers(client, [patches], patch_object)
+    submit_layers(client, delete_layers(deletes), lambda key: client.delete(key[0] + "/" + key[1], tx))
+
+    ## commit transaction - a rejected transaction is returned without a state, only the BIG-IP's message
+    response = client.commit(tx).json()
+    result = response.get("state")
+    if result == "COMPLETED":
+        client.discovery_update(creates + patches, replace_deletes + deletes, wanted)
+        if cached:
+            state_cache.record(client, name, digest)
     else:
-        error_exit("Incorrect state value entered.")
-
-
-## layer 2 service procedures
-def service_layer2(configs):
-
-    ## state value
-    if "state" in configs["service"].keys():
-        state = configs["service"]["state"]
-    else:
-        state = "present"
-
-    ## name value
-    if "name" in configs["service"].keys():
-        name = configs["service"]["name"]
-    else:
-        error_exit("No service name supplied in YAML")
-
-    ## host value
-    if "host" in configs.keys():
-        host = configs["host"]
-    else:
-        error_exit("No host name supplied in YAML")
-
-    ## user value
-    if "user" in configs.keys():
-        user = configs["user"]
-    else:
-        error_exit("No username supplied in YAML")
-
-    ## password value
-    if "password" in configs.keys():
-        password = configs["password"]
-    else:
-        error_exit("No password supplied in YAML")
-
-    ## process state
-    if state == "absent":
-        print("Deleting Layer 2 Service Objects")
-        
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-    elif state == "present":
-        print("Creating Layer 2 Service Objects")
-        #### Parse YAML values ####
-
-        ## sslo-side-net and svc-side-net base keys
-        if "sslo-side-net" in configs["service"].keys() and "svc-side-net" in configs["service"].keys():
-            pass
+        client.discovery_forget()
+        if cached:
+            state_cache.forget(client, name)
+        if result != "PLANNED":
+            raise ServiceError("Failed to apply service objects: " + str(response.get("message", result)))
+    report(result)
+    return result
+
+
+## stable integer digest of a string - Python's hash() is randomized per process, so it cannot derive addresses
+def stable_hash(value):
+    return int(hashlib.sha256(value.encode("utf-8")).hexdigest(), 16)
+
+
+## layer 2 address plan - returns {device: (route domain, third octet, /29 slot)}. Values already on the BIG-IP for this service
+## are kept (so re-applying never moves a device), new devices get a digest-derived route domain and the first free /29 of
+## the service's 198.18.x.0/24 subnets (32 devices per subnet). Route domains and subnets in use by anything else are skipped.
+def layer2_allocation(client, name, devices):
+    prefix = "svc-" + name + "-"
+
+    ## existing route domains and self-IPs (one query each)
+    route_domains = client.get("/mgmt/tm/net/route-domain?$select=name,id").get("items", [])
+    selfs = client.get("/mgmt/tm/net/self?$select=name,address").get("items", [])
+    owned = client.service_devices(name, devices)
+
+    used_rds = set()
+    own_rds = {}
+    for x in route_domains:
+        if service_owns(x["name"], name, owned):
+            for d in devices:
+                if x["name"] == prefix + d + "-svc-rd":
+                    own_rds[d] = int(x["id"])
         else:
-            error_exit("Missing sslo-side-net or svc-side-net keys.")
-
-        ## sslo-side-net values
-        if "entry-interface" in configs["service"]["sslo-side-net"].keys() and "entry-self" in configs["service"]["sslo-side-net"].keys() and "return-interface" in configs["service"]["sslo-side-net"].keys() and "return-self" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_interface = str(configs["service"]["sslo-side-net"]["entry-interface"])
-            sslo_side_net_entry_self = configs["service"]["sslo-side-net"]["entry-self"]
-            sslo_side_net_return_interface = str(configs["service"]["sslo-side-net"]["return-interface"])
-            sslo_side_net_return_self = configs["service"]["sslo-side-net"]["return-self"]
+            used_rds.add(int(x.get("id", 0)))
+
+    used_octets = set()
+    own_slots = {}
+    for x in selfs:
+        address = x.get("address", "").split("/")[0].split("%")[0].split(".")
+        if len(address) != 4 or address[0:2] != ["198", "18"]:
+            continue
+        if service_owns(x["name"], name, owned):
+            for d in devices:
+                if x["name"] == prefix + d + "-svc-in":
+                    own_slots[d] = (int(address[2]), (int(address[3]) - 1) // 8)
         else:
-            error_exit("Missing entry and/or return sslo-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_tag = str(configs["service"]["sslo-side-net"]["entry-tag"])
-        else:
-            sslo_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_return_tag = str(configs["service"]["sslo-side-net"]["return-tag"])
-        else:
-            sslo_side_net_return_tag = "none"
-
-        ## svc-side-net values
-        svc_side_net_list = []
-        for x in configs["service"]["svc-side-net"]:
-            if "entry-interface" in x and "return-interface" in x and "name" in x:
-                svc_side_net_list.append(x)
+            used_octets.add(int(address[2]))
+
+    ## subnets - the ones this service already uses, more are added (digest-derived, probing upwards) when they are full
+    octets = []
+    for d in devices:
+        if d in own_slots and own_slots[d][0] not in used_octets and own_slots[d][0] not in octets:
+            octets.append(own_slots[d][0])
+
+    ## /29 slots - devices keep their current slot, new devices take the first free one
+    slots = {}
+    for d in devices:
+        if d in own_slots and own_slots[d][0] in octets and own_slots[d] not in slots.values():
+            slots[d] = own_slots[d]
+    for d in devices:
+        if d in slots:
+            continue
+        free = [(o, x) for o in octets for x in range(32) if (o, x) not in slots.values()]
+        if not free:
+            octet = (stable_hash(name) % 252) + 1
+            for i in range(252):
+                candidate = ((octet - 1 + i) % 252) + 1
+                if candidate not in used_octets and candidate not in octets:
+                    octets.append(candidate)
+                    break
             else:
-                error_exit("Missing entry and/or return svc-side interface/self values.")
-
-        #### Create or modify named objects ####
-        
-        ## make sure the data group exists
-        sslo_datagroup(user, password, host)
-
-        ## create the library iRules
-        sslo_library_rule(user, password, host)
-
-        ## create tmsh transaction to build network objects
-        s = requests.session()
-        s.auth = (user, password)
-        s.verify = False
-        s.headers.update({'Content-Type':'application/json'})
-
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-        ## build transaction
-        tx = s.post("https://" + host + "/mgmt/tm/transaction", data=json.dumps({})).json()['transId']
-        s.headers.update({'X-F5-REST-Coordination-Id': str(tx)})
-
-        ## build objects - sslo-side entry vlan
-        if sslo_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-in","interfaces":"" + str(sslo_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-in","tag":"" + str(sslo_side_net_entry_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side return vlan
-        if sslo_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-out","interfaces":"" + str(sslo_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+                raise ServiceError("No free 198.18.x.0/24 subnet left for layer 2 service " + name)
+            free = [(octets[-1], 0)]
+        slots[d] = free[0]
+
+    ## route domains - devices keep their current route domain, new devices get a digest-derived one (probing upwards)
+    allocation = {}
+    assigned = set()
+    for d in devices:
+        if d in own_rds and own_rds[d] not in used_rds and own_rds[d] not in assigned:
+            route_domain = own_rds[d]
         else:
-            datastr = {"name":"svc-" + name + "-sslo-side-out","tag":"" + str(sslo_side_net_return_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side entry self
-        datastr = {"name":"svc-" + name + "-sslo-side-in","vlan":"svc-" + name + "-sslo-side-in","address":"" + sslo_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side return self
-        datastr = {"name":"svc-" + name + "-sslo-side-out","vlan":"svc-" + name + "-sslo-side-out","address":"" + sslo_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side entry float self
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-sslo-side-in-float","vlan":"svc-" + name + "-sslo-side-in","address":"" + configs["service"]["sslo-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## create source-side pool list
-        svc_pool = []
-        counter = 1
-
-        ## define third octet (same for all devices in this service) as hash of the service name
-        third_octet = (hash(name) % 252) + 1
-
-        ## create svc-side objects
-        for x in svc_side_net_list:
-            ## We will algorithmically define the IP subnets, self-IPs, and route domains for each L2 device so that the user doesn't have to define them.
-            ## The base subnet for all layer 2 devices is 198.18.0.0/16
-            ## The third octet is defined (for all devices in a service) as a hash of the service name (mod 252 + 1) - ex. 198.18.1.y
-            ## The route domain is defined (for each device) as a hash of the service name + device name (mod 50000 + 10000)
-            ## The fourth octet is defined (for each device) from a /29 mapping table based on the order of the device in the list
-            ## The active device in an HA pair (or single device) uses the first and second IPs in the /29 subnet as entry and return self IPs
-            ## The standby device in an HA pair uses the third and fourth IPs in the /29 subnet as entry and return self IPs
-            ## The last IP in the /29 subnet is used as the floating (return) self IP
-            ## Using this hash method guarantees that each BIG-IP in an HA pair uses the same values (other than entry/return self offsets)
-
-            ## define the route domain (per device) as hash of service name + device name
-            route_domain = (hash(name + x["name"]) % 50000) + 10000
-
-            ## determine if this is the active or standby box in HA config, or just active box in standalone - determines the IPs used in the selected subnet
-            resp = s.get("https://" + host + "/mgmt/tm/cm/failover-status").json()["entries"]["https://localhost/mgmt/tm/cm/failover-status/0"]["nestedStats"]["entries"]["status"]["description"]
-            ha_state = (1, 2)[resp == "ACTIVE"]
-
-            ## select a /29 subnet range based on number of device in the list of devices (from counter)
-            net_map = {1:"1:6",2:"9:14",3:"17:22",4:"25:30",5:"33:38",6:"41:46",7:"49:54",8:"57-62",9:"65:70",10:"73:78",11:"81:86",12:"89:94",13:"97:102",14:"104:110",15:"113:118"}
-            subnet = net_map[counter]
-
-            ## define the entry and return IPs based on third octet and ha_state
-            ip_list = subnet.split(":")
-            if ha_state == 1:
-                entry_ip = "198.18." + str(third_octet) + "." + str(ip_list[0])
-                return_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 1) 
+            start = stable_hash(name + d) % 50000
+            for i in range(50000):
+                route_domain = ((start + i) % 50000) + 10000
+                if route_domain not in used_rds and route_domain not in assigned:
+                    break
             else:
-                entry_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 2)
-                return_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 3)
-
-            ## floating (return) IP is the last number in the /29 subnet range
-            float_ip = "198.18." + str(third_octet) + "." + str(ip_list[-1])
-
-            ## pool member is the floating IP of each device
-            svc_pool.append(float_ip)
-
-            ## increment the counter
-            counter += 1
-
-            ## svc entry vlan
-            if "entry-tag" not in x:
-                datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-in","interfaces":"" + str(x["entry-interface"]) + ""}
-                s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-            else:
-                datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-in","tag":"" + str(x["entry-tag"]) + "","interfaces":[{"name":"" + str(x["entry-interface"]) + "","tagged":True}]}
-                s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-            ## svc return vlan
-            if "return-tag" not in x:
-                datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out","interfaces":"" + str(x["return-interface"]) + ""}
-                s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-            else:
-                datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out","tag":"" + str(x["return-tag"]) + "","interfaces":[{"name":"" + str(x["return-interface"]) + "","tagged":True}]}
-                s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-            ## svc return route domain
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-rd","parent":0,"id":str(route_domain),"vlans":["svc-" + name + "-" + x["name"] + "-svc-out"]}
-            s.post("https://" + host + "/mgmt/tm/net/route-domain", data=json.dumps(datastr))
-
-            ## svc entry self
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-in","vlan":"svc-" + name + "-" + x["name"] + "-svc-in","address":"" + str(entry_ip) + "/29","allowService":"default","trafficGroup":"traffic-group-local-only"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-            ## svc return self
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out","vlan":"svc-" + name + "-" + x["name"] + "-svc-out","address":"" + str(return_ip) + "%" + str(route_domain) + "/29","allowService":"default","trafficGroup":"traffic-group-local-only"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-            ## svc return floating self
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out-float","vlan":"svc-" + name + "-" + x["name"] + "-svc-out","address":"" + str(float_ip) + "%" + str(route_domain) + "/29","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-            ## svc return rule
-            #datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { node [call sslo-tier-library::get_data \"" + name + "\"] }"}
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out-rule","apiAnonymous":"when CLIENT_ACCEPTED { catch { node [call sslo-tier-library::get_data \"" + name + "\" \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"] }}"}
-            s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-            ## svc return virtual
-            datastr = {"name":"svc-" + name + "-" + x["name"] + "-svc-out","source":"0.0.0.0%" + str(route_domain) + "/0","destination":"0.0.0.0%" + str(route_domain) + ":0","mask":"any","profiles":"/Common/fastL4","rules":["svc-" + name + "-" + x["name"] + "-svc-out-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-" + x["name"] + "-svc-out"],"vlansEnabled":True}
-            s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## svc entry rule
-        #datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" }"}
-        datastr = {"name":"svc-" + name + "-svc-in-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\" }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## monitor
-        datastr = {"name":"svc-" + name + "-monitor","interval":3,"timeout":7}
-        s.post("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp", data=json.dumps(datastr))
-
-        ## svc entry pool
-        mbrstr = []
-        for ip in svc_pool:
-            mbrdict = {"name":"" + ip + ":any","address":"" + ip + ""}
-            mbrstr.append(mbrdict)
-
-        datastr = {"name":"svc-" + name + "-svc-pool","monitor":"/Common/svc-" + name + "-monitor","members":mbrstr}
-        #datastr = {"name":"svc-" + name + "-svc-pool","monitor":"/Common/gateway_icmp","members":mbrstr}
-        s.post("https://" + host + "/mgmt/tm/ltm/pool", data=json.dumps(datastr))
-
-        ## monitor rule
-        datastr = {"name":"svc-" + name + "-monitor-rule","apiAnonymous":"when FLOW_INIT { if { [active_members svc-" + name + "-svc-pool] < 1 } {drop} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## svc entry vip
-        datastr = {"name":"svc-" + name + "-svc-in","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","pool":"svc-" + name + "-svc-pool","profiles":"/Common/fastL4","rules":["svc-" + name + "-svc-in-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## monitor virtual
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-float"].split("/")
-        else:
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-self"].split("/")
-
-        datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip[0] + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## commit transaction
-        del s.headers['X-F5-REST-Coordination-Id']
-        result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()['state']
-        #result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()
-        print(result)
-
-    else:
-        error_exit("Incorrect state value entered.")
-
-
-## http service procedures
-def service_http_explicit(configs):
-    ## state value
-    if "state" in configs["service"].keys():
-        state = configs["service"]["state"]
-    else:
-        state = "present"
-
-    ## name value
-    if "name" in configs["service"].keys():
-        name = configs["service"]["name"]
-    else:
-        error_exit("No service name supplied in YAML")
-
-    ## host value
-    if "host" in configs.keys():
-        host = configs["host"]
-    else:
-        error_exit("No host name supplied in YAML")
-
-    ## user value
-    if "user" in configs.keys():
-        user = configs["user"]
+                raise ServiceError("No free route domain left for layer 2 service " + name)
+        assigned.add(route_domain)
+        allocation[d] = (route_domain, slots[d][0], slots[d][1])
+    return allocation
+
+
+## vlan payload from a YAML network section (sslo-side-net, svc-side-net or a layer 2 device) - leg is "entry" or "return".
+## The interface value may be a single interface or a list of interfaces, the VLAN is tagged when a tag is supplied
+def vlan_descriptor(vlan_name, section, leg):
+    interfaces = section[leg + "-interface"]
+    if not isinstance(interfaces, list):
+        interfaces = [interfaces]
+    ## untagged interfaces are listed as such (the BIG-IP reports them with "untagged", not "tagged": false), so a VLAN that
+    ## was tagged before is modified back to untagged
+    if leg + "-tag" in section:
+        return {"name":vlan_name,"tag":str(section[leg + "-tag"]),"interfaces":[{"name":str(x),"tagged":True} for x in interfaces]}
+    return {"name":vlan_name,"interfaces":[{"name":str(x),"untagged":True} for x in interfaces]}
+
+
+## self-IP payload - local (non-floating) self-IPs are unit-specific, floating ones follow traffic-group-1
+def self_descriptor(self_name, vlan_name, address, floating=False):
+    return {"name":self_name,"vlan":vlan_name,"address":str(address),"allowService":"default","trafficGroup":("traffic-group-local-only", "traffic-group-1")[floating]}
+
+
+## flow keys the library procs record and look up - the TCP 4-tuple, or the split session header of the HTTP services
+flow_tuple = "\"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\""
+
+
+## split session token of the HTTP services (split-token) - made once per client connection and sent to the security devices
+## in the X-F5-SplitSession2 header. "random" builds 15 random letters (15 rand() and format calls and a subst), "connection"
+## uses the connection 4-tuple as is (unique among the live connections, unlike a short hash of it)
+split_tokens = {
+    "random":"[subst [string repeat {[format %c [expr {int(rand() * 26) + (rand() > .5 ? 97 : 65)}]]} 15]]",
+    "connection":"\"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\""
+}
+
+
+## service rule code - "set" records the flow on the way to the security devices, "get" sends it back to the SSLO instance
+## it came from, "monitor" drops the monitor virtual's traffic when no security device is up. With per-connection keying
+## (table-keying: connection) the HTTP rules touch the session table once per connection instead of on every request: the
+## sslo-side records the flow on the first request (and again once half the idle timeout has passed, so the entry cannot
+## expire under a long keep-alive connection), the svc-side keeps the node found for the token in a connection variable
+def rule_code(ctx, event, flow="tcp", tuple=flow_tuple, pool=None):
+    name = ctx["name"]
+    if event == "monitor":
+        return "when FLOW_INIT { if { [active_members svc-" + name + "-" + pool + "] < 1 } {drop} }"
+    if event == "set" and flow == "tcp":
+        return "when CLIENT_ACCEPTED { call sslo-tier-library::" + ctx["set_proc"] + " \"" + name + "\" " + tuple + ctx["table_args"] + " }"
+    if event == "set" and ctx["table_keying"] == "connection":
+        return "when HTTP_REQUEST { if { ![info exists randstr] } { set randstr " + split_tokens[ctx["split_token"]] + " } ; HTTP::header insert \"X-F5-SplitSession2\" ${randstr} ; if { ![info exists recorded] || [clock seconds] - ${recorded} >= " + str(ctx["table_refresh"]) + " } { call sslo-tier-library::" + ctx["set_proc"] + " \"" + name + "\" ${randstr}" + ctx["table_args"] + " ; set recorded [clock seconds] } }"
+    if event == "set":
+        return "when HTTP_REQUEST { if { ![info exists randstr] } { set randstr " + split_tokens[ctx["split_token"]] + " } ; HTTP::header insert \"X-F5-SplitSession2\" ${randstr} ; call sslo-tier-library::" + ctx["set_proc"] + " \"" + name + "\" ${randstr}" + ctx["table_args"] + " }"
+    if flow == "tcp":
+        return "when CLIENT_ACCEPTED { catch { node [call sslo-tier-library::" + ctx["get_proc"] + " \"" + name + "\" " + tuple + "] }}"
+    if ctx["table_keying"] == "connection":
+        return "when HTTP_REQUEST { set token [HTTP::header \"X-F5-SplitSession2\"] ; if { ![info exists sslo_token] || ${token} ne ${sslo_token} || ${sslo_node} eq \"\" } { set sslo_token ${token} ; set sslo_node [call sslo-tier-library::" + ctx["get_proc"] + " \"" + name + "\" ${token}] } ; catch { node ${sslo_node} }}"
+    return "when HTTP_REQUEST { catch { node [call sslo-tier-library::" + ctx["get_proc"] + " \"" + name + "\" [HTTP::header \"X-F5-SplitSession2\"]] }}"
+
+
+## object builders - one per object type of the service models, each returns the (collection, payload) list of one spec
+
+## VLAN of a network section
+def object_vlan(ctx, spec):
+    section = ctx["service"][spec["side"]]
+    return [("/mgmt/tm/net/vlan", vlan_descriptor("svc-" + ctx["name"] + "-" + spec["vlan"], section, spec["leg"]))]
+
+
+## local self-IP of a network section
+def object_self(ctx, spec):
+    section = ctx["service"][spec["side"]]
+    name = "svc-" + ctx["name"] + "-" + spec["vlan"]
+    return [("/mgmt/tm/net/self", self_descriptor(name, name, section[spec["leg"] + "-self"]))]
+
+
+## floating self-IP of a network section (only when the YAML supplies one)
+def object_float(ctx, spec):
+    section = ctx["service"][spec["side"]]
+    if spec["leg"] + "-float" not in section:
+        return []
+    name = "svc-" + ctx["name"] + "-" + spec["vlan"]
+    return [("/mgmt/tm/net/self", self_descriptor(name + "-float", name, section[spec["leg"] + "-float"], True))]
+
+
+## security device monitors (monitors, default a single gateway-icmp monitor)
+def object_monitor(ctx, spec):
+    return ctx["monitors"]
+
+
+## security device pool
+def object_pool(ctx, spec):
+    monitor = " and ".join("/Common/" + datastr["name"] for path, datastr in ctx["monitors"])
+    datastr = {"name":"svc-" + ctx["name"] + "-" + spec["name"],"monitor":monitor,"members":ctx["members"]}
+    datastr.update(ctx["pool"])
+    return [("/mgmt/tm/ltm/pool", datastr)]
+
+
+## SNAT pool (only when the YAML supplies a list of SNAT addresses)
+def object_snatpool(ctx, spec):
+    if ctx["snat"] != "snatpool":
+        return []
+    return [("/mgmt/tm/ltm/snatpool", {"name":"svc-" + ctx["name"] + "-" + spec["name"],"members":ctx["snat_members"]})]
+
+
+## service or monitor rule
+def object_rule(ctx, spec):
+    if spec["event"] == "monitor" and ctx["monitor_virtual"] == "pool":
+        return []
+    return [("/mgmt/tm/ltm/rule", {"name":"svc-" + ctx["name"] + "-" + spec["name"],"apiAnonymous":rule_code(ctx, spec["event"], spec.get("flow", "tcp"), pool=spec.get("pool"))})]
+
+
+## service virtual - listens on all addresses, or on the sslo-side entry-ip (destination "entry-ip")
+def object_virtual(ctx, spec):
+    name = ctx["name"]
+    datastr = {"name":"svc-" + name + "-" + spec["name"],"source":"0.0.0.0/0"}
+    if spec.get("destination") == "entry-ip":
+        datastr["destination"] = ctx["service"]["sslo-side-net"]["entry-ip"] + ":0"
+        datastr["mask"] = "255.255.255.255"
     else:
-        error_exit("No username supplied in YAML")
-
-    ## password value
-    if "password" in configs.keys():
-        password = configs["password"]
+        datastr["destination"] = "0.0.0.0:0"
+        datastr["mask"] = "any"
+    if "pool" in spec:
+        datastr["pool"] = "svc-" + name + "-" + spec["pool"]
+    if spec.get("tcp"):
+        datastr["ipProtocol"] = "tcp"
+    if "profiles" in spec:
+        datastr["profiles"] = spec["profiles"]
+    if "rule" in spec:
+        datastr["rules"] = ["svc-" + name + "-" + spec["rule"]]
+    if spec.get("snat") and ctx["snat"] == "automap":
+        datastr["sourceAddressTranslation"] = {"type":"automap"}
+    elif spec.get("snat") and ctx["snat"] == "snatpool":
+        datastr["sourceAddressTranslation"] = {"type":"snat","pool":"svc-" + name + "-snat-pool"}
+    datastr["translateAddress"] = ("disabled", "enabled")[bool(spec.get("translate"))]
+    datastr["translatePort"] = "disabled"
+    datastr["vlans"] = ["svc-" + name + "-" + spec["vlan"]]
+    datastr["vlansEnabled"] = True
+    return [("/mgmt/tm/ltm/virtual", datastr)]
+
+
+## monitor virtual - SSLO monitors the service through it, on the sslo-side entry-ip, or the entry float (or self) address.
+## With monitor-virtual "pool" it has no rule: its default pool is the security device pool, and the virtual drops new
+## connections while that pool is down, so the TCP half-open probes of the SSLO instances are answered without an iRule
+def object_monitor_virtual(ctx, spec):
+    name = ctx["name"]
+    section = ctx["service"]["sslo-side-net"]
+    if spec["address"] == "entry-ip":
+        monitor_ip = section["entry-ip"]
+    elif "entry-float" in section:
+        monitor_ip = section["entry-float"].split("/")[0]
     else:
-        error_exit("No password supplied in YAML")
-
-    ## process state
-    if state == "absent":
-        #### Delete named objects
-        print("Deleting HTTP Explicit Proxy Service Objects")
-        
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-    elif state == "present":
-        #### Parse YAML values ####
-        print("Creating HTTP Explicit Proxy Service Objects")
-
-        ## sslo-side-net and svc-side-net base keys
-        if "sslo-side-net" in configs["service"].keys() and "svc-side-net" in configs["service"].keys():
-            pass
-        else:
-            error_exit("Missing sslo-side-net or svc-side-net keys.")
-
-        ## sslo-side-net values
-        if "entry-interface" in configs["service"]["sslo-side-net"].keys() and "entry-self" in configs["service"]["sslo-side-net"].keys() and "entry-ip" in configs["service"]["sslo-side-net"].keys() and "return-interface" in configs["service"]["sslo-side-net"].keys() and "return-self" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_interface = str(configs["service"]["sslo-side-net"]["entry-interface"])
-            sslo_side_net_entry_self = configs["service"]["sslo-side-net"]["entry-self"]
-            sslo_side_net_entry_ip = configs["service"]["sslo-side-net"]["entry-ip"]
-            sslo_side_net_return_interface = str(configs["service"]["sslo-side-net"]["return-interface"])
-            sslo_side_net_return_self = configs["service"]["sslo-side-net"]["return-self"]
+        monitor_ip = section["entry-self"].split("/")[0]
+    datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True,"serviceDownImmediateAction":"none"}
+    if ctx["monitor_virtual"] == "pool":
+        datastr.update({"pool":"svc-" + name + "-" + spec["pool"], "rules":[], "serviceDownImmediateAction":"drop"})
+    return [("/mgmt/tm/ltm/virtual", datastr)]
+
+
+## layer 2 device objects - for every device in svc-side-net: entry and return VLANs, return route domain, self-IPs, return
+## rule and return virtual
+def object_layer2_devices(ctx, spec):
+    name = ctx["name"]
+    objects = []
+
+    ## determine if this is the active or standby box in HA config, or just active box in standalone - determines the IPs used in the selected subnet
+    ha_state = (1, 2)[ctx["client"].facts()["failover"] == "ACTIVE"]
+
+    for x in ctx["service"]["svc-side-net"]:
+        ## We will algorithmically define the IP subnets, self-IPs, and route domains for each L2 device so that the user doesn't have to define them.
+        ## The base subnet for all layer 2 devices is 198.18.0.0/16
+        ## Each service uses one or more 198.18.x.0/24 subnets, the first one derived from a digest of the service name - ex. 198.18.1.y
+        ## The route domain is defined (for each device) from a digest of the service name + device name (mod 50000 + 10000)
+        ## Each device uses its own /29 of the service's subnets (32 devices per /24)
+        ## Subnets and route domains already used by other objects are skipped, and a device keeps its values on later runs
+        ## The active device in an HA pair (or single device) uses the first and second IPs in the /29 subnet as entry and return self IPs
+        ## The standby device in an HA pair uses the third and fourth IPs in the /29 subnet as entry and return self IPs
+        ## The last IP in the /29 subnet is used as the floating (return) self IP
+        ## Using a stable digest guarantees that each BIG-IP in an HA pair uses the same values (other than entry/return self offsets)
+
+        device = "svc-" + name + "-" + str(x["name"])
+        route_domain, third_octet, slot = ctx["allocation"][str(x["name"])]
+
+        ## first and last usable IPs of the device's /29 subnet
+        ip_list = [slot * 8 + 1, slot * 8 + 6]
+
+        ## define the entry and return IPs based on third octet and ha_state
+        if ha_state == 1:
+            entry_ip = "198.18." + str(third_octet) + "." + str(ip_list[0])
+            return_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 1)
         else:
-            error_exit("Missing entry and/or return sslo-side interface/self values.")
+            entry_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 2)
+            return_ip = "198.18." + str(third_octet) + "." + str(int(ip_list[0]) + 3)
 
-        if "entry-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_tag = str(configs["service"]["sslo-side-net"]["entry-tag"])
-        else:
-            sslo_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_return_tag = str(configs["service"]["sslo-side-net"]["return-tag"])
-        else:
-            sslo_side_net_return_tag = "none"
-
-        ## svc-side-net values
-        if "entry-interface" in configs["service"]["svc-side-net"].keys() and "entry-self" in configs["service"]["svc-side-net"].keys() and "return-interface" in configs["service"]["svc-side-net"].keys() and "return-self" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_interface = str(configs["service"]["svc-side-net"]["entry-interface"])
-            svc_side_net_entry_self = configs["service"]["svc-side-net"]["entry-self"]
-            svc_side_net_return_interface = str(configs["service"]["svc-side-net"]["return-interface"])
-            svc_side_net_return_self = configs["service"]["svc-side-net"]["return-self"]
-        else:
-            error_exit("Missing entry and/or return svc-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_tag = str(configs["service"]["svc-side-net"]["entry-tag"])
-        else:
-            svc_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_return_tag = str(configs["service"]["svc-side-net"]["return-tag"])
-        else:
-            svc_side_net_return_tag = "none"
-        
-        ## svc-members values
-        if "svc-members" in configs["service"].keys():
-            mbrstr = []
-            for x in configs["service"]["svc-members"]:
-                vals = x.split(":")
-                mbrdict = {"name":"" + x + ":" + vals[1] + "","address":"" + vals[0] + ""}
-                mbrstr.append(mbrdict)
-        else:
-            error_exit("Missing svc-members key.")
+        ## floating (return) IP is the last number in the /29 subnet range
+        float_ip = "198.18." + str(third_octet) + "." + str(ip_list[-1])
 
+        ## svc entry and return vlans
+        objects.append(("/mgmt/tm/net/vlan", vlan_descriptor(device + "-svc-in", x, "entry")))
+        objects.append(("/mgmt/tm/net/vlan", vlan_descriptor(device + "-svc-out", x, "return")))
 
-        #### Create or modify named objects ####
-        
-        ## make sure the data group exists
-        sslo_datagroup(user, password, host)
+        ## svc return route domain
+        objects.append(("/mgmt/tm/net/route-domain", {"name":device + "-svc-rd","parent":0,"id":str(route_domain),"vlans":[device + "-svc-out"]}))
 
-        ## create the library iRules
-        sslo_library_rule(user, password, host)
+        ## svc entry self, return self and return floating self
+        objects.append(("/mgmt/tm/net/self", self_descriptor(device + "-svc-in", device + "-svc-in", entry_ip + "/29")))
+        objects.append(("/mgmt/tm/net/self", self_descriptor(device + "-svc-out", device + "-svc-out", return_ip + "%" + str(route_domain) + "/29")))
+        objects.append(("/mgmt/tm/net/self", self_descriptor(device + "-svc-out-float", device + "-svc-out", float_ip + "%" + str(route_domain) + "/29", True)))
 
-        ## create tmsh transaction to build network objects
-        s = requests.session()
-        s.auth = (user, password)
-        s.verify = False
-        s.headers.update({'Content-Type':'application/json'})
-
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-        ## make sure nodes don't exist
-        for x in configs["service"]["svc-members"]:
-            vals = x.split(":")
-            resp = s.get("https://" + host + "/mgmt/tm/node/" + vals[0] + "").json()
-            if "kind" in resp:
-                s.delete("https://" + host + "/mgmt/tm/node/" + vals[0] + "")
-
-        ## build transaction
-        tx = s.post("https://" + host + "/mgmt/tm/transaction", data=json.dumps({})).json()['transId']
-        s.headers.update({'X-F5-REST-Coordination-Id': str(tx)})
-
-        ## build objects - sslo-side entry vlan
-        if sslo_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-in","interfaces":"" + str(sslo_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+        ## svc return rule - the return virtual is in the device's route domain, with the direct lookups (optimized library
+        ## variant or subtable) the suffix is removed here with one string map instead of being searched for in the library
+        if ctx["get_proc"] != "get_data":
+            tuple = "[string map [list \"%[ROUTE::domain]\" \"\"] " + flow_tuple + "]"
         else:
-            datastr = {"name":"svc-" + name + "-sslo-side-in","tag":"" + str(sslo_side_net_entry_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side return vlan
-        if sslo_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-out","interfaces":"" + str(sslo_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-out","tag":"" + str(sslo_side_net_return_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## svc-side entry vlan
-        if svc_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-in","interfaces":"" + str(svc_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+            tuple = flow_tuple
+        objects.append(("/mgmt/tm/ltm/rule", {"name":device + "-svc-out-rule","apiAnonymous":rule_code(ctx, "get", tuple=tuple)}))
+
+        ## svc return virtual
+        objects.append(("/mgmt/tm/ltm/virtual", {"name":device + "-svc-out","source":"0.0.0.0%" + str(route_domain) + "/0","destination":"0.0.0.0%" + str(route_domain) + ":0","mask":"any","profiles":"/Common/fastL4","rules":[device + "-svc-out-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":[device + "-svc-out"],"vlansEnabled":True}))
+    return objects
+
+
+object_builders = {
+    "vlan":object_vlan,
+    "self":object_self,
+    "float":object_float,
+    "monitor":object_monitor,
+    "pool":object_pool,
+    "snatpool":object_snatpool,
+    "rule":object_rule,
+    "virtual":object_virtual,
+    "monitor-virtual":object_monitor_virtual,
+    "layer2-devices":object_layer2_devices
+}
+
+
+## network section specs shared by the models - VLAN, self-IP and (optional) floating self-IP of each leg
+sslo_side_entry = {"side":"sslo-side-net", "leg":"entry", "vlan":"sslo-side-in"}
+sslo_side_return = {"side":"sslo-side-net", "leg":"return", "vlan":"sslo-side-out"}
+svc_side_entry = {"side":"svc-side-net", "leg":"entry", "vlan":"svc-side-in"}
+svc_side_return = {"side":"svc-side-net", "leg":"return", "vlan":"svc-side-out"}
+
+
+## service object models - per service type: the report title, the required YAML values (key lists per network section,
+## layer 2 lists devices in svc-side-net), how the pool members are given, whether the library rule is used, whether the
+## HTTP service options apply, and the typed object specs the service is built from (in one pass, in this order)
+service_models = {
+    "layer3":{
+        "title":"Layer 3",
+        "required":{"sslo-side-net":["entry-interface", "entry-self", "return-interface", "return-self"], "svc-side-net":["entry-interface", "entry-self", "return-interface", "return-self"]},
+        "members":"address",
+        "library":True,
+        "objects":[
+            ("vlan", sslo_side_entry), ("vlan", sslo_side_return), ("vlan", svc_side_entry), ("vlan", svc_side_return),
+            ("self", sslo_side_entry), ("self", sslo_side_return), ("float", sslo_side_entry),
+            ("self", svc_side_entry), ("self", svc_side_return), ("float", svc_side_entry), ("float", svc_side_return),
+            ("monitor", {}),
+            ("pool", {"name":"service-pool"}),
+            ("rule", {"name":"sslo-side-rule", "event":"set"}),
+            ("rule", {"name":"svc-side-rule", "event":"get"}),
+            ("rule", {"name":"monitor-rule", "event":"monitor", "pool":"service-pool"}),
+            ("virtual", {"name":"sslo-side", "pool":"service-pool", "profiles":"/Common/fastL4", "rule":"sslo-side-rule", "vlan":"sslo-side-in"}),
+            ("virtual", {"name":"svc-side", "profiles":"/Common/fastL4", "rule":"svc-side-rule", "vlan":"svc-side-out"}),
+            ("monitor-virtual", {"address":"entry-float", "pool":"service-pool"})
+        ]
+    },
+    "layer2":{
+        "title":"Layer 2",
+        "required":{"sslo-side-net":["entry-interface", "entry-self", "return-interface", "return-self"], "svc-side-net":["entry-interface", "return-interface", "name"]},
+        "devices":True,
+        "members":"devices",
+        "library":True,
+        "objects":[
+            ("vlan", sslo_side_entry), ("vlan", sslo_side_return),
+            ("self", sslo_side_entry), ("self", sslo_side_return), ("float", sslo_side_entry),
+            ("layer2-devices", {}),
+            ("rule", {"name":"svc-in-rule", "event":"set"}),
+            ("monitor", {}),
+            ("pool", {"name":"svc-pool"}),
+            ("rule", {"name":"monitor-rule", "event":"monitor", "pool":"svc-pool"}),
+            ("virtual", {"name":"svc-in", "pool":"svc-pool", "profiles":"/Common/fastL4", "rule":"svc-in-rule", "vlan":"sslo-side-in"}),
+            ("monitor-virtual", {"address":"entry-float", "pool":"svc-pool"})
+        ]
+    },
+    "http_explicit":{
+        "title":"HTTP Explicit Proxy",
+        "http":True,
+        "required":{"sslo-side-net":["entry-interface", "entry-self", "entry-ip", "return-interface", "return-self"], "svc-side-net":["entry-interface", "entry-self", "return-interface", "return-self"]},
+        "members":"address-port",
+        "library":True,
+        "objects":[
+            ("vlan", sslo_side_entry), ("vlan", sslo_side_return), ("vlan", svc_side_entry), ("vlan", svc_side_return),
+            ("self", sslo_side_entry), ("self", sslo_side_return),
+            ("self", svc_side_entry), ("self", svc_side_return), ("float", svc_side_entry), ("float", svc_side_return),
+            ("monitor", {}),
+            ("pool", {"name":"service-pool"}),
+            ("rule", {"name":"sslo-side-rule", "event":"set", "flow":"http"}),
+            ("rule", {"name":"svc-side-rule", "event":"get", "flow":"http"}),
+            ("rule", {"name":"monitor-rule", "event":"monitor", "pool":"service-pool"}),
+            ("virtual", {"name":"sslo-side", "destination":"entry-ip", "pool":"service-pool", "tcp":True, "profiles":"/Common/http", "rule":"sslo-side-rule", "translate":True, "vlan":"sslo-side-in"}),
+            ("virtual", {"name":"svc-side", "profiles":"/Common/http", "rule":"svc-side-rule", "vlan":"svc-side-out"}),
+            ("monitor-virtual", {"address":"entry-ip", "pool":"service-pool"})
+        ]
+    },
+    "http_transparent":{
+        "title":"HTTP Transparent",
+        "http":True,
+        "required":{"sslo-side-net":["entry-interface", "entry-self", "return-interface", "return-self"], "svc-side-net":["entry-interface", "entry-self", "return-interface", "return-self"]},
+        "members":"address",
+        "library":True,
+        "objects":[
+            ("vlan", sslo_side_entry), ("vlan", sslo_side_return), ("vlan", svc_side_entry), ("vlan", svc_side_return),
+            ("self", sslo_side_entry), ("self", sslo_side_return), ("float", sslo_side_entry),
+            ("self", svc_side_entry), ("self", svc_side_return), ("float", svc_side_entry), ("float", svc_side_return),
+            ("monitor", {}),
+            ("pool", {"name":"service-pool"}),
+            ("rule", {"name":"sslo-side-rule", "event":"set", "flow":"http"}),
+            ("rule", {"name":"svc-side-rule", "event":"get", "flow":"http"}),
+            ("rule", {"name":"monitor-rule", "event":"monitor", "pool":"service-pool"}),
+            ("virtual", {"name":"sslo-side", "pool":"service-pool", "tcp":True, "profiles":"/Common/http", "rule":"sslo-side-rule", "vlan":"sslo-side-in"}),
+            ("virtual", {"name":"svc-side", "profiles":"/Common/http", "rule":"svc-side-rule", "vlan":"svc-side-out"}),
+            ("monitor-virtual", {"address":"entry-float", "pool":"service-pool"})
+        ]
+    },
+    "icap":{
+        "title":"ICAP",
+        "required":{"sslo-side-net":["entry-interface", "entry-self", "entry-ip"], "svc-side-net":["entry-interface", "entry-self"]},
+        "members":"address",
+        "library":False,
+        "objects":[
+            ("vlan", sslo_side_entry), ("vlan", svc_side_entry),
+            ("self", sslo_side_entry), ("self", svc_side_entry),
+            ("monitor", {}),
+            ("pool", {"name":"service-pool"}),
+            ("snatpool", {"name":"snat-pool"}),
+            ("rule", {"name":"monitor-rule", "event":"monitor", "pool":"service-pool"}),
+            ("virtual", {"name":"sslo-side", "destination":"entry-ip", "pool":"service-pool", "tcp":True, "snat":True, "translate":True, "vlan":"sslo-side-in"}),
+            ("monitor-virtual", {"address":"entry-ip", "pool":"service-pool"})
+        ]
+    }
+}
+
+
+## security device monitor types (monitors) - collection and default values. icap is a tcp monitor sending an ICAP OPTIONS
+## request, inband monitors watch the service's own traffic instead of sending probes
+monitor_types = {
+    "gateway-icmp":("/mgmt/tm/ltm/monitor/gateway-icmp", {"interval":3, "timeout":7}),
+    "tcp-half-open":("/mgmt/tm/ltm/monitor/tcp-half-open", {"interval":5, "timeout":16}),
+    "tcp":("/mgmt/tm/ltm/monitor/tcp", {"interval":5, "timeout":16, "send":"", "recv":""}),
+    "http":("/mgmt/tm/ltm/monitor/http", {"interval":5, "timeout":16, "send":"GET / HTTP/1.0\\r\\n\\r\\n", "recv":""}),
+    "icap":("/mgmt/tm/ltm/monitor/tcp", {"interval":5, "timeout":16, "port":1344, "path":"", "recv":"ICAP/1.0 200"}),
+    "inband":("/mgmt/tm/ltm/monitor/inband", {"failures":3, "failure-interval":30, "response-time":10, "retry-time":300})
+}
+
+
+## name of a service's monitor of a type - gateway-icmp keeps the name the tool has always used (svc-<name>-monitor), the other
+## types are named svc-<name>-<type>-monitor
+def monitor_name(name, type):
+    return "svc-" + name + "-monitor" if type == "gateway-icmp" else "svc-" + name + "-" + type + "-monitor"
+
+
+## collection of a service's monitor, from its name - None if the name is not one of the service's monitors
+def monitor_collection(objname, name):
+    for type in monitor_types:
+        if objname == monitor_name(name, type):
+            return monitor_types[type][0]
+    return None
+
+
+## monitor types that probe a port - without a port of their own they use the member port, which only the members of the
+## HTTP explicit proxies have (the other pool members listen on any port, and a monitor on *:* is rejected for them)
+port_monitors = ["tcp-half-open", "tcp", "http"]
+
+
+## monitor payloads of a service from its monitors list - returns [(collection, payload)]. ports tells if the pool members
+## have a port of their own
+def service_monitors(name, monitors, ports=False):
+    if not isinstance(monitors, list) or not monitors:
+        raise ServiceError("Incorrect monitors value entered (a list of monitors).")
+    objects = []
+    for x in monitors:
+        if not isinstance(x, dict) or x.get("type") not in monitor_types:
+            raise ServiceError("Incorrect monitor type entered (" + ", ".join(sorted(monitor_types)) + ").")
+        path, defaults = monitor_types[x["type"]]
+        values = dict(defaults)
+        values.update(x)
+        for key in ["interval", "timeout", "port", "failures", "failure-interval", "response-time", "retry-time"]:
+            if key in values and (not str(values[key]).isdigit() or int(values[key]) < 1):
+                raise ServiceError("Incorrect monitor " + key + " value entered.")
+        if x["type"] in port_monitors and "port" not in values and not ports:
+            raise ServiceError("Missing monitor port value (required for " + x["type"] + " monitors, as the svc-members have no port).")
+
+        monitor = monitor_name(name, x["type"])
+        if monitor in [datastr["name"] for p, datastr in objects]:
+            raise ServiceError("Duplicate monitor type " + x["type"] + ".")
+        datastr = {"name":monitor}
+        if x["type"] == "inband":
+            datastr.update({"failures":int(values["failures"]), "failureInterval":int(values["failure-interval"]), "responseTime":int(values["response-time"]), "retryTime":int(values["retry-time"])})
         else:
-            datastr = {"name":"svc-" + name + "-svc-side-in","tag":"" + str(svc_side_net_entry_tag) + "","interfaces":[{"name":"" + str(svc_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+            datastr.update({"interval":int(values["interval"]), "timeout":int(values["timeout"])})
+        if x["type"] == "icap":
+            datastr["send"] = "OPTIONS icap://icap/" + str(values["path"]).lstrip("/") + " ICAP/1.0\\r\\nHost: icap\\r\\nEncapsulated: null-body=0\\r\\n\\r\\n"
+            datastr["recv"] = str(values["recv"])
+        elif x["type"] in ("tcp", "http"):
+            datastr["send"] = str(values["send"])
+            datastr["recv"] = str(values["recv"])
+        if "port" in values:
+            datastr["destination"] = "*:" + str(values["port"])
+        objects.append((path, datastr))
+    return objects
+
+
+## pool load balancing methods (lb-mode) - YAML value and BIG-IP loadBalancingMode
+lb_modes = {
+    "round-robin":"round-robin",
+    "least-connections":"least-connections-member",
+    "ratio":"ratio-member",
+    "dynamic-ratio":"dynamic-ratio-member",
+    "predictive":"predictive-member"
+}
+
+
+## pool member with its ratio (default 1) and connection-limit (default 0, no limit)
+def pool_member(name, address, values):
+    ratio = str(values.get("ratio", 1))
+    limit = str(values.get("connection-limit", 0))
+    if not ratio.isdigit() or int(ratio) < 1:
+        raise ServiceError("Incorrect svc-members ratio value entered.")
+    if not limit.isdigit():
+        raise ServiceError("Incorrect svc-members connection-limit value entered.")
+    return {"name":name, "address":address, "ratio":int(ratio), "connectionLimit":int(limit)}
+
+
+## parse and check the YAML values of a service against its model - returns the service context the object builders use
+def service_context(configs, model):
+    service = configs["service"]
+    ctx = {"name":service["name"], "service":service, "set_proc":None, "get_proc":None, "table_args":"", "snat":"none", "split_token":"random", "table_keying":"request", "monitor_virtual":"rule"}
 
-        ## svc-side return vlan
-        if svc_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-out","interfaces":"" + str(svc_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
+    ## sslo-side-net and svc-side-net base keys
+    if "sslo-side-net" not in service.keys() or "svc-side-net" not in service.keys():
+        raise ServiceError("Missing sslo-side-net or svc-side-net keys.")
+
+    ## sslo-side-net and svc-side-net values (layer 2 lists one svc-side-net section per device)
+    for side, label in [("sslo-side-net", "sslo-side"), ("svc-side-net", "svc-side")]:
+        sections = service[side] if model.get("devices") and side == "svc-side-net" else [service[side]]
+        for section in sections:
+            for key in model["required"][side]:
+                if key not in section:
+                    raise ServiceError("Missing entry and/or return " + label + " interface/self values.")
+
+    ## SNAT (ICAP) - automap, or a list of SNAT addresses
+    if "entry-snat" in service["svc-side-net"] and not model.get("devices"):
+        if service["svc-side-net"]["entry-snat"] == "automap":
+            ctx["snat"] = "automap"
+        elif isinstance(service["svc-side-net"]["entry-snat"], list):
+            ctx["snat"] = "snatpool"
+            ctx["snat_members"] = ["/Common/" + str(x) for x in service["svc-side-net"]["entry-snat"]]
         else:
-            datastr = {"name":"svc-" + name + "-svc-side-out","tag":"" + str(svc_side_net_return_tag) + "","interfaces":[{"name":"" + str(svc_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side entry self
-        datastr = {"name":"svc-" + name + "-sslo-side-in","vlan":"svc-" + name + "-sslo-side-in","address":"" + sslo_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side return self
-        datastr = {"name":"svc-" + name + "-sslo-side-out","vlan":"svc-" + name + "-sslo-side-out","address":"" + sslo_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry self
-        datastr = {"name":"svc-" + name + "-svc-side-in","vlan":"svc-" + name + "-svc-side-in","address":"" + svc_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return self
-        datastr = {"name":"svc-" + name + "-svc-side-out","vlan":"svc-" + name + "-svc-side-out","address":"" + svc_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry float self
-        if "entry-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-in-float","vlan":"svc-" + name + "-svc-side-in","address":"" + configs["service"]["svc-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return float self
-        if "return-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-out-float","vlan":"svc-" + name + "-svc-side-out","address":"" + configs["service"]["svc-side-net"]["return-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## monitor
-        datastr = {"name":"svc-" + name + "-monitor","interval":3,"timeout":7}
-        s.post("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp", data=json.dumps(datastr))
-
-        ## service pool
-        datastr = {"name":"svc-" + name + "-service-pool","monitor":"/Common/svc-" + name + "-monitor","members":mbrstr}
-        s.post("https://" + host + "/mgmt/tm/ltm/pool", data=json.dumps(datastr))
-
-        ## service rules
-        #datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" }"}
-        datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when HTTP_REQUEST { if { ![info exists randstr] } { set randstr [subst [string repeat {[format %c [expr {int(rand() * 26) + (rand() > .5 ? 97 : 65)}]]} 15]] } ; HTTP::header insert \"X-F5-SplitSession2\" ${randstr} ; call sslo-tier-library::set_data \"" + name + "\" ${randstr} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        #datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { node [call sslo-tier-library::get_data \"" + name + "\"] }"}
-        datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when HTTP_REQUEST { catch { node [call sslo-tier-library::get_data \"" + name + "\" [HTTP::header \"X-F5-SplitSession2\"]] }}"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## monitor rule
-        datastr = {"name":"svc-" + name + "-monitor-rule","apiAnonymous":"when FLOW_INIT { if { [active_members svc-" + name + "-service-pool] < 1 } {drop} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## service virtuals
-        datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"" + sslo_side_net_entry_ip + ":0","mask":"255.255.255.255","pool":"svc-" + name + "-service-pool","ipProtocol":"tcp","profiles":"/Common/http","rules":["svc-" + name + "-sslo-side-rule"],"translateAddress":"enabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        datastr = {"name":"svc-" + name + "-svc-side","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","profiles":"/Common/http","rules":["svc-" + name + "-svc-side-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-svc-side-out"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## monitor virtual
-        monitor_ip = configs["service"]["sslo-side-net"]["entry-ip"]
-        datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## commit transaction
-        del s.headers['X-F5-REST-Coordination-Id']
-        result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()['state']
-        #result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()
-        print(result)
-
-    else:
-        error_exit("Incorrect state value entered.")
-
+            raise ServiceError("Incorrect ICAP SNAT value.")
+
+    ## svc-members values - addresses (any port), or address:port for the HTTP explicit proxies. An entry is either the
+    ## address itself, or a block with the address and its ratio and connection-limit
+    if model["members"] != "devices":
+        if "svc-members" not in service.keys():
+            raise ServiceError("Missing svc-members key.")
+        ctx["members"] = []
+        for x in service["svc-members"]:
+            values = x if isinstance(x, dict) else {"address":x}
+            if "address" not in values:
+                raise ServiceError("Missing svc-members address value.")
+            address = str(values["address"])
+            if model["members"] == "address-port":
+                ctx["members"].append(pool_member(address, address.split(":")[0], values))
+            else:
+                ctx["members"].append(pool_member(address + ":any", address, values))
+
+    ## pool load balancing method and slow ramp time
+    if str(service.get("lb-mode", "round-robin")) not in lb_modes:
+        raise ServiceError("Incorrect lb-mode value entered (" + ", ".join(sorted(lb_modes)) + ").")
+    if not str(service.get("slow-ramp", 10)).isdigit():
+        raise ServiceError("Incorrect slow-ramp value entered.")
+    ctx["pool"] = {"loadBalancingMode":lb_modes[str(service.get("lb-mode", "round-robin"))], "slowRampTime":int(service.get("slow-ramp", 10))}
+
+    ## security device monitors
+    ctx["monitors"] = service_monitors(ctx["name"], service.get("monitors", [{"type":"gateway-icmp"}]), model["members"] == "address-port")
+
+    ## monitor virtual design - the FLOW_INIT rule, or the availability of the virtual's own default pool
+    if "monitor-virtual" in service.keys():
+        if service["monitor-virtual"] not in ("rule", "pool"):
+            raise ServiceError("Incorrect monitor-virtual value entered (rule or pool).")
+        ctx["monitor_virtual"] = service["monitor-virtual"]
+
+    ## HTTP service options - rejected for the other service types rather than silently ignored
+    for key in ["split-token", "table-keying"]:
+        if key in service.keys() and not model.get("http"):
+            raise ServiceError("The " + key + " value is only supported by the HTTP services (http_explicit, http_transparent).")
+
+    ## library and session table options - rejected for the services that do not record their flows (icap)
+    for key in ["library", "table-timeout", "table-lifetime", "table-subtable"]:
+        if key in service.keys() and not model["library"]:
+            raise ServiceError("The " + key + " value is only supported by the services using the library (layer3, layer2, http_explicit, http_transparent).")
+    if "table-subtable" in service.keys() and not isinstance(service["table-subtable"], bool):
+        raise ServiceError("Incorrect table-subtable value entered (true or false).")
+
+    ## split session token (HTTP services)
+    if "split-token" in service.keys():
+        if service["split-token"] not in split_tokens:
+            raise ServiceError("Incorrect split-token value entered (random or connection).")
+        ctx["split_token"] = service["split-token"]
+
+    ## library variant and session table values
+    if model["library"]:
+        ctx["set_proc"], ctx["get_proc"], ctx["table_args"] = service_library(configs)
+
+    ## session table keying (HTTP services) - per request, or per connection (recorded again after half the idle timeout,
+    ## or half the lifetime if that is shorter, so the entry never expires under a connection that still counts it as recorded)
+    if "table-keying" in service.keys():
+        if service["table-keying"] not in ("request", "connection"):
+            raise ServiceError("Incorrect table-keying value entered (request or connection).")
+        timeout, lifetime = table_values(service)
+        refresh = timeout if lifetime == "indefinite" else min(timeout, lifetime)
+        ctx["table_keying"] = service["table-keying"]
+        ctx["table_refresh"] = max(1, refresh // 2)
+    return ctx
+
+
+## layer 2 devices - allocate the route domain and /29 subnet of each device, the pool members are the devices' floating IPs
+## (with the ratio and connection-limit of each device section)
+def layer2_devices(ctx):
+    devices = [str(x["name"]) for x in ctx["service"]["svc-side-net"]]
+    if len(set(devices)) != len(devices):
+        raise ServiceError("Duplicate svc-side-net device names.")
+    ctx["allocation"] = layer2_allocation(ctx["client"], ctx["name"], devices)
+    ctx["members"] = []
+    for section in ctx["service"]["svc-side-net"]:
+        route_domain, third_octet, slot = ctx["allocation"][str(section["name"])]
+        float_ip = "198.18." + str(third_octet) + "." + str(slot * 8 + 6)
+        ctx["members"].append(pool_member(float_ip + ":any", float_ip, section))
+
+
+## build the desired object set of a service (collection, payload) in one pass over its model
+def build_objects(model, ctx):
+    desired = []
+    for type, spec in model["objects"]:
+        desired += object_builders[type](ctx, spec)
+    return desired
+
+
+## security service procedures - layer 3, layer 2, http explicit, http transparent and icap services are all built from
+## their object model
+def service_objects(configs):
+    model = service_models[configs["service"]["type"]]
 
-def service_http_transparent(configs):
     ## state value
     if "state" in configs["service"].keys():
         state = configs["service"]["state"]
@@ -933,420 +1780,60 @@ def service_http_transparent(configs):
     if "name" in configs["service"].keys():
         name = configs["service"]["name"]
     else:
-        error_exit("No service name supplied in YAML")
+        raise ServiceError("No service name supplied in YAML")
 
     ## host value
     if "host" in configs.keys():
         host = configs["host"]
     else:
-        error_exit("No host name supplied in YAML")
+        raise ServiceError("No host name supplied in YAML")
 
     ## user value
     if "user" in configs.keys():
         user = configs["user"]
     else:
-        error_exit("No username supplied in YAML")
+        raise ServiceError("No username supplied in YAML")
 
     ## password value
     if "password" in configs.keys():
         password = configs["password"]
     else:
-        error_exit("No password supplied in YAML")
+        raise ServiceError("No password supplied in YAML")
 
     ## process state
     if state == "absent":
         #### Delete named objects
-        print("Deleting HTTP Transparent Service Objects")
-        
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-
-    elif state == "present":
-        #### Parse YAML values ####
-        print("Creating HTTP Transparent Service Objects")
-
-        ## sslo-side-net and svc-side-net base keys
-        if "sslo-side-net" in configs["service"].keys() and "svc-side-net" in configs["service"].keys():
-            pass
-        else:
-            error_exit("Missing sslo-side-net or svc-side-net keys.")
-
-        ## sslo-side-net values
-        if "entry-interface" in configs["service"]["sslo-side-net"].keys() and "entry-self" in configs["service"]["sslo-side-net"].keys() and "return-interface" in configs["service"]["sslo-side-net"].keys() and "return-self" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_interface = str(configs["service"]["sslo-side-net"]["entry-interface"])
-            sslo_side_net_entry_self = configs["service"]["sslo-side-net"]["entry-self"]
-            sslo_side_net_return_interface = str(configs["service"]["sslo-side-net"]["return-interface"])
-            sslo_side_net_return_self = configs["service"]["sslo-side-net"]["return-self"]
-        else:
-            error_exit("Missing entry and/or return sslo-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_tag = str(configs["service"]["sslo-side-net"]["entry-tag"])
-        else:
-            sslo_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_return_tag = str(configs["service"]["sslo-side-net"]["return-tag"])
-        else:
-            sslo_side_net_return_tag = "none"
-
-        ## svc-side-net values
-        if "entry-interface" in configs["service"]["svc-side-net"].keys() and "entry-self" in configs["service"]["svc-side-net"].keys() and "return-interface" in configs["service"]["svc-side-net"].keys() and "return-self" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_interface = str(configs["service"]["svc-side-net"]["entry-interface"])
-            svc_side_net_entry_self = configs["service"]["svc-side-net"]["entry-self"]
-            svc_side_net_return_interface = str(configs["service"]["svc-side-net"]["return-interface"])
-            svc_side_net_return_self = configs["service"]["svc-side-net"]["return-self"]
-        else:
-            error_exit("Missing entry and/or return svc-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_tag = str(configs["service"]["svc-side-net"]["entry-tag"])
-        else:
-            svc_side_net_entry_tag = "none"
-
-        if "return-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_return_tag = str(configs["service"]["svc-side-net"]["return-tag"])
-        else:
-            svc_side_net_return_tag = "none"
-        
-        ## svc-members values
-        if "svc-members" in configs["service"].keys():
-            mbrstr = []
-            for x in configs["service"]["svc-members"]:
-                mbrdict = {"name":"" + x + ":any","address":"" + x + ""}
-                mbrstr.append(mbrdict)
-        else:
-            error_exit("Missing svc-members key.")
-
-
-        #### Create or modify named objects ####
-        
-        ## make sure the data group exists
-        sslo_datagroup(user, password, host)
-
-        ## create the library iRules
-        sslo_library_rule(user, password, host)
-
-        ## create tmsh transaction to build network objects
-        s = requests.session()
-        s.auth = (user, password)
-        s.verify = False
-        s.headers.update({'Content-Type':'application/json'})
+        report("Deleting " + model["title"] + " Service Objects")
 
         ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-        ## make sure nodes don't exist
-        for x in configs["service"]["svc-members"]:
-            vals = x.split(":")
-            resp = s.get("https://" + host + "/mgmt/tm/node/" + vals[0] + "").json()
-            if "kind" in resp:
-                s.delete("https://" + host + "/mgmt/tm/node/" + vals[0] + "")
-
-        ## build transaction
-        tx = s.post("https://" + host + "/mgmt/tm/transaction", data=json.dumps({})).json()['transId']
-        s.headers.update({'X-F5-REST-Coordination-Id': str(tx)})
-
-        ## build objects - sslo-side entry vlan
-        if sslo_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-in","interfaces":"" + str(sslo_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-in","tag":"" + str(sslo_side_net_entry_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side return vlan
-        if sslo_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-out","interfaces":"" + str(sslo_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-out","tag":"" + str(sslo_side_net_return_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## svc-side entry vlan
-        if svc_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-in","interfaces":"" + str(svc_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-svc-side-in","tag":"" + str(svc_side_net_entry_tag) + "","interfaces":[{"name":"" + str(svc_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## svc-side return vlan
-        if svc_side_net_return_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-out","interfaces":"" + str(svc_side_net_return_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-svc-side-out","tag":"" + str(svc_side_net_return_tag) + "","interfaces":[{"name":"" + str(svc_side_net_return_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side entry self
-        datastr = {"name":"svc-" + name + "-sslo-side-in","vlan":"svc-" + name + "-sslo-side-in","address":"" + sslo_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side return self
-        datastr = {"name":"svc-" + name + "-sslo-side-out","vlan":"svc-" + name + "-sslo-side-out","address":"" + sslo_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## sslo-side entry float self
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-sslo-side-in-float","vlan":"svc-" + name + "-sslo-side-in","address":"" + configs["service"]["sslo-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry self
-        datastr = {"name":"svc-" + name + "-svc-side-in","vlan":"svc-" + name + "-svc-side-in","address":"" + svc_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return self
-        datastr = {"name":"svc-" + name + "-svc-side-out","vlan":"svc-" + name + "-svc-side-out","address":"" + svc_side_net_return_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry float self
-        if "entry-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-in-float","vlan":"svc-" + name + "-svc-side-in","address":"" + configs["service"]["svc-side-net"]["entry-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side return float self
-        if "return-float" in configs["service"]["svc-side-net"].keys():
-            datastr = {"name":"svc-" + name + "-svc-side-out-float","vlan":"svc-" + name + "-svc-side-out","address":"" + configs["service"]["svc-side-net"]["return-float"] + "","allowService":"default","trafficGroup":"traffic-group-1"}
-            s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## monitor
-        datastr = {"name":"svc-" + name + "-monitor","interval":3,"timeout":7}
-        s.post("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp", data=json.dumps(datastr))
-
-        ## service pool
-        datastr = {"name":"svc-" + name + "-service-pool","monitor":"/Common/svc-" + name + "-monitor","members":mbrstr}
-        s.post("https://" + host + "/mgmt/tm/ltm/pool", data=json.dumps(datastr))
-
-        ## service rules
-        #datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { call sslo-tier-library::set_data \"" + name + "\" }"}
-        datastr = {"name":"svc-" + name + "-sslo-side-rule","apiAnonymous":"when HTTP_REQUEST { if { ![info exists randstr] } { set randstr [subst [string repeat {[format %c [expr {int(rand() * 26) + (rand() > .5 ? 97 : 65)}]]} 15]] } ; HTTP::header insert \"X-F5-SplitSession2\" ${randstr} ; call sslo-tier-library::set_data \"" + name + "\" ${randstr} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        #datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when CLIENT_ACCEPTED { node [call sslo-tier-library::get_data \"" + name + "\"] }"}
-        datastr = {"name":"svc-" + name + "-svc-side-rule","apiAnonymous":"when HTTP_REQUEST { catch { node [call sslo-tier-library::get_data \"" + name + "\" [HTTP::header \"X-F5-SplitSession2\"]] }}"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## monitor rule
-        datastr = {"name":"svc-" + name + "-monitor-rule","apiAnonymous":"when FLOW_INIT { if { [active_members svc-" + name + "-service-pool] < 1 } {drop} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## service virtuals
-        datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","pool":"svc-" + name + "-service-pool","ipProtocol":"tcp","profiles":"/Common/http","rules":["svc-" + name + "-sslo-side-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        datastr = {"name":"svc-" + name + "-svc-side","source":"0.0.0.0/0","destination":"0.0.0.0:0","mask":"any","profiles":"/Common/http","rules":["svc-" + name + "-svc-side-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-svc-side-out"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## monitor virtual
-        if "entry-float" in configs["service"]["sslo-side-net"].keys():
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-float"].split("/")
-        else:
-            monitor_ip = configs["service"]["sslo-side-net"]["entry-self"].split("/")
-
-        datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip[0] + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## commit transaction
-        del s.headers['X-F5-REST-Coordination-Id']
-        result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()['state']
-        #result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()
-        print(result)
-
-    else:
-        error_exit("Incorrect state value entered.")
-
-
-## icap service procedures
-def service_icap(configs):
-    ## state value
-    if "state" in configs["service"].keys():
-        state = configs["service"]["state"]
-    else:
-        state = "present"
-
-    ## name value
-    if "name" in configs["service"].keys():
-        name = configs["service"]["name"]
-    else:
-        error_exit("No service name supplied in YAML")
-
-    ## host value
-    if "host" in configs.keys():
-        host = configs["host"]
-    else:
-        error_exit("No host name supplied in YAML")
-
-    ## user value
-    if "user" in configs.keys():
-        user = configs["user"]
-    else:
-        error_exit("No username supplied in YAML")
-
-    ## password value
-    if "password" in configs.keys():
-        password = configs["password"]
-    else:
-        error_exit("No password supplied in YAML")
-
-    ## process state
-    if state == "absent":
-        #### Delete named objects
-        print("Deleting ICAP Service Objects")
-        
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
+        return reset_objects(get_client(host, user, password), name)
 
     elif state == "present":
         #### Parse YAML values ####
-        print("Creating ICAP Service Objects")
-
-        ## sslo-side-net and svc-side-net base keys
-        if "sslo-side-net" in configs["service"].keys() and "svc-side-net" in configs["service"].keys():
-            pass
-        else:
-            error_exit("Missing sslo-side-net or svc-side-net keys.")
-
-        ## sslo-side-net values
-        if "entry-interface" in configs["service"]["sslo-side-net"].keys() and "entry-self" in configs["service"]["sslo-side-net"].keys() and "entry-ip" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_interface = str(configs["service"]["sslo-side-net"]["entry-interface"])
-            sslo_side_net_entry_self = configs["service"]["sslo-side-net"]["entry-self"]
-            sslo_side_net_entry_ip = configs["service"]["sslo-side-net"]["entry-ip"]
-        else:
-            error_exit("Missing entry and/or return sslo-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["sslo-side-net"].keys():
-            sslo_side_net_entry_tag = str(configs["service"]["sslo-side-net"]["entry-tag"])
-        else:
-            sslo_side_net_entry_tag = "none"
-
-        if "entry-snat" in configs["service"]["svc-side-net"].keys():
-            if configs["service"]["svc-side-net"]["entry-snat"] == "automap":
-                sslo_side_net_entry_snat = "automap"
-            elif isinstance(configs["service"]["svc-side-net"]["entry-snat"], list):
-                sslo_side_net_entry_snat = "snatpool"
-                snatstr = []
-                for x in configs["service"]["svc-side-net"]["entry-snat"]:
-                    snatstr.append("/Common/" + str(x))
-            else:
-                error_exit("Incorrect ICAP SNAT value.")
-
-        ## svc-side-net values
-        if "entry-interface" in configs["service"]["svc-side-net"].keys() and "entry-self" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_interface = str(configs["service"]["svc-side-net"]["entry-interface"])
-            svc_side_net_entry_self = configs["service"]["svc-side-net"]["entry-self"]
-        else:
-            error_exit("Missing entry and/or return svc-side interface/self values.")
-
-        if "entry-tag" in configs["service"]["svc-side-net"].keys():
-            svc_side_net_entry_tag = str(configs["service"]["svc-side-net"]["entry-tag"])
-        else:
-            svc_side_net_entry_tag = "none"
-        
-        ## svc-members values
-        if "svc-members" in configs["service"].keys():
-            mbrstr = []
-            for x in configs["service"]["svc-members"]:
-                mbrdict = {"name":"" + x + ":any","address":"" + x + ""}
-                mbrstr.append(mbrdict)
-        else:
-            error_exit("Missing svc-members key.")
-
+        report("Creating " + model["title"] + " Service Objects")
+        ctx = service_context(configs, model)
 
         #### Create or modify named objects ####
-        
-        ## make sure the data group exists
-        sslo_datagroup(user, password, host)
 
-        ## create the library iRules
-        sslo_library_rule(user, password, host)
+        ## make sure the data group and library iRules exist (once per BIG-IP per run)
+        client = get_client(host, user, password)
+        sslo_prerequisites(client)
+        ctx["client"] = client
+        if model["members"] == "devices":
+            ## the route domains and subnets are read, picked and committed under the BIG-IP's allocation lock - concurrent
+            ## layer 2 services (--dir, several files) would otherwise all see the same ones as free
+            with client.allocation_lock:
+                layer2_devices(ctx)
+                return apply_objects(client, name, build_objects(model, ctx))
 
-        ## create tmsh transaction to build network objects
-        s = requests.session()
-        s.auth = (user, password)
-        s.verify = False
-        s.headers.update({'Content-Type':'application/json'})
+        ## desired object set (collection, payload) - reconciled against the objects already on the BIG-IP
+        desired = build_objects(model, ctx)
 
-        ## reset any possible existing objects
-        reset_objects(host, user, password, name)
-
-        ## make sure nodes don't exist
-        for x in configs["service"]["svc-members"]:
-            vals = x.split(":")
-            resp = s.get("https://" + host + "/mgmt/tm/node/" + vals[0] + "").json()
-            if "kind" in resp:
-                s.delete("https://" + host + "/mgmt/tm/node/" + vals[0] + "")
-
-        ## build transaction
-        tx = s.post("https://" + host + "/mgmt/tm/transaction", data=json.dumps({})).json()['transId']
-        s.headers.update({'X-F5-REST-Coordination-Id': str(tx)})
-
-        ## build objects - sslo-side entry vlan
-        if sslo_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-sslo-side-in","interfaces":"" + str(sslo_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side-in","tag":"" + str(sslo_side_net_entry_tag) + "","interfaces":[{"name":"" + str(sslo_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## svc-side entry vlan
-        if svc_side_net_entry_tag == "none":
-            datastr = {"name":"svc-" + name + "-svc-side-in","interfaces":"" + str(svc_side_net_entry_interface) + ""}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-        else:
-            datastr = {"name":"svc-" + name + "-svc-side-in","tag":"" + str(svc_side_net_entry_tag) + "","interfaces":[{"name":"" + str(svc_side_net_entry_interface) + "","tagged":True}]}
-            s.post("https://" + host + "/mgmt/tm/net/vlan", data=json.dumps(datastr))
-
-        ## sslo-side entry self
-        datastr = {"name":"svc-" + name + "-sslo-side-in","vlan":"svc-" + name + "-sslo-side-in","address":"" + sslo_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## svc-side entry self
-        datastr = {"name":"svc-" + name + "-svc-side-in","vlan":"svc-" + name + "-svc-side-in","address":"" + svc_side_net_entry_self + "","allowService":"default","trafficGroup":"traffic-group-local-only"}
-        s.post("https://" + host + "/mgmt/tm/net/self", data=json.dumps(datastr))
-
-        ## monitor
-        datastr = {"name":"svc-" + name + "-monitor","interval":3,"timeout":7}
-        s.post("https://" + host + "/mgmt/tm/ltm/monitor/gateway-icmp", data=json.dumps(datastr))
-
-        ## service pool
-        datastr = {"name":"svc-" + name + "-service-pool","monitor":"/Common/svc-" + name + "-monitor","members":mbrstr}
-        s.post("https://" + host + "/mgmt/tm/ltm/pool", data=json.dumps(datastr))
-
-        ## snat pool
-        if sslo_side_net_entry_snat == "snatpool":
-            datastr = {"name":"svc-" + name + "-snat-pool","members":snatstr}
-            s.post("https://" + host + "/mgmt/tm/ltm/snatpool", data=json.dumps(datastr))
-
-        ## monitor rule
-        datastr = {"name":"svc-" + name + "-monitor-rule","apiAnonymous":"when FLOW_INIT { if { [active_members svc-" + name + "-service-pool] < 1 } {drop} }"}
-        s.post("https://" + host + "/mgmt/tm/ltm/rule", data=json.dumps(datastr))
-
-        ## service virtuals
-        if sslo_side_net_entry_snat == "automap":
-            datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"" + sslo_side_net_entry_ip + ":0","mask":"255.255.255.255","pool":"svc-" + name + "-service-pool","ipProtocol":"tcp","sourceAddressTranslation":{"type":"automap"},"translateAddress":"enabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        elif sslo_side_net_entry_snat == "snatpool":
-            datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"" + sslo_side_net_entry_ip + ":0","mask":"255.255.255.255","pool":"svc-" + name + "-service-pool","ipProtocol":"tcp","sourceAddressTranslation":{"type":"snat","pool":"svc-" + name + "-snat-pool"},"translateAddress":"enabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        else:
-            datastr = {"name":"svc-" + name + "-sslo-side","source":"0.0.0.0/0","destination":"" + sslo_side_net_entry_ip + ":0","mask":"255.255.255.255","pool":"svc-" + name + "-service-pool","ipProtocol":"tcp","translateAddress":"enabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## monitor virtual
-        monitor_ip = configs["service"]["sslo-side-net"]["entry-ip"]
-        datastr = {"name":"svc-" + name + "-monitor","source":"0.0.0.0/0","destination":monitor_ip + ":9999","mask":"255.255.255.255","profiles":"/Common/tcp","ip-protocol":"tcp","rules":["svc-" + name + "-monitor-rule"],"translateAddress":"disabled","translatePort":"disabled","vlans":["svc-" + name + "-sslo-side-in"],"vlansEnabled":True}
-        s.post("https://" + host + "/mgmt/tm/ltm/virtual", data=json.dumps(datastr))
-
-        ## commit transaction
-        del s.headers['X-F5-REST-Coordination-Id']
-        result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()['state']
-        #result = s.patch("https://" + host + "/mgmt/tm/transaction/{}".format(tx), data=json.dumps({"state":"VALIDATING"})).json()
-        print(result)
+        ## create, modify and delete only the objects that differ from the desired set
+        return apply_objects(client, name, desired)
 
     else:
-        error_exit("Incorrect state value entered.")
+        raise ServiceError("Incorrect state value entered.")
 
 
 ## service mapping procedures
@@ -1355,80 +1842,769 @@ def service_mapping(configs):
     if "host" in configs.keys():
         host = configs["host"]
     else:
-        error_exit("No host name supplied in YAML")
+        raise ServiceError("No host name supplied in YAML")
 
     ## user value
     if "user" in configs.keys():
         user = configs["user"]
     else:
-        error_exit("No username supplied in YAML")
+        raise ServiceError("No username supplied in YAML")
 
     ## password value
     if "password" in configs.keys():
         password = configs["password"]
     else:
-        error_exit("No password supplied in YAML")
+        raise ServiceError("No password supplied in YAML")
 
     ## sslo-side-net and svc-side-net base keys
     if "mapping" not in configs["service"].keys():
-        error_exit("Missing sslo-side-net or svc-side-net keys.")
+        raise ServiceError("Missing sslo-side-net or svc-side-net keys.")
     
     ## create data group key:value list
-    datastr = []
+    records = {}
     for x in configs["service"]["mapping"]:
         service = x["service"]
         for y in x["maps"]:
             srcmac = y["srcmac"]
             destip = y["destip"]
-            datadict = {"name":"" + service + ":" + srcmac + "","data":"" + destip + ""}
-            datastr.append(datadict)
-
-    ## update sslo-tier-datagroup
-    s = requests.session()
-    s.auth = (user, password)
-    s.verify = False
-    s.headers.update({'Content-Type':'application/json'})
-    
-    datastr = {"records":datastr}
-    s.patch("https://" + host + "/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup", data=json.dumps(datastr))
-    print("COMPLETED")
-
-
-## Test command-line arguments
-try:
-    parser = ArgumentParser()
-    parser.add_argument("-f", "--file", dest="filename", help="Input a configuration file", metavar="FILE", required=True)
-    args = parser.parse_args()
-except:
-    error_exit("Incorrect arguments supplied.")
-
-
-## Test supplied YAML file for existence and structure
-try:
-    with open(args.filename, "r") as file:
-        configs = safe_load(file)
-except:
-    error_exit("Failed to open supplied file, or incorrect YAML format.")
-
-
-## Test YAML file for required content
-try:
-    type = configs["service"]["type"]
-    if type == "layer3":
-        service_layer3(configs)
-    elif type == "layer2":
-        service_layer2(configs)
-    elif type == "http_explicit":
-        service_http_explicit(configs)
-    elif type == "http_transparent":
-        service_http_transparent(configs)
-    elif type == "icap":
-        service_icap(configs)
-    elif type == "mapping":
-        service_mapping(configs)
+            records["" + service + ":" + srcmac + ""] = "" + destip + ""
+
+    ## data group backend - internal (records kept in the configuration) or external (records kept in a file, for very large tables)
+    if "datagroup" in configs["service"].keys():
+        backend = configs["service"]["datagroup"]
     else:
-        error_exit("Incorrect service type specified")
+        backend = "internal"
+    if backend not in ("internal", "external"):
+        raise ServiceError("Incorrect datagroup value entered (internal or external).")
+
+    client = get_client(host, user, password)
+
+    ## current records, from whichever backend holds them now
+    internal = client.get("/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup")
+    external = client.get("/mgmt/tm/sys/file/data-group/sslo-tier-datagroup")
+    current = {}
+    if "selfLink" in internal:
+        for x in internal.get("records", []):
+            current[x["name"]] = x.get("data", "")
+    elif "sourcePath" in external:
+        current = external_records(client, external["sourcePath"])
+
+    ## single record edits from the command line are applied to the current records (the file only supplies the BIG-IP)
+    if mapping_edits["add"] or mapping_edits["remove"]:
+        if current is None:
+            raise ServiceError("The current records of the external data group could not be read back (" + external["sourcePath"] + ").")
+        records = dict(current)
+        records.update(mapping_edits["add"])
+        for x in mapping_edits["remove"]:
+            if x not in records:
+                raise ServiceError("Mapping record " + x + " does not exist.")
+            del records[x]
+
+    if backend == "external":
+        return apply_external_records(client, internal, external, current, records)
+
+    ## switching back from the external backend - the external data group is replaced by an internal one in one transaction
+    if "selfLink" not in internal and "selfLink" in external:
+        report("Mapping changes: " + str(len(records)) + " add (external data group replaced by an internal data group)")
+        tx = client.transaction()
+        client.delete("/mgmt/tm/ltm/data-group/external/sslo-tier-datagroup", tx)
+        client.delete("/mgmt/tm/sys/file/data-group/sslo-tier-datagroup", tx)
+        client.post("/mgmt/tm/ltm/data-group/internal", {"name":"sslo-tier-datagroup", "type":"string", "records":[{"name":x, "data":records[x]} for x in sorted(records)]}, tx)
+        return commit_records(client, tx)
+
+    sslo_prerequisites(client)
+
+    ## full replace requested - PATCH the complete record list over the data group
+    if rebuild:
+        return replace_records(client, records)
+
+    return apply_records(client, current, records)
+
+
+## PATCH the complete record list over the data group (one request, applied as a whole)
+def replace_records(client, records):
+    datastr = {"records":[{"name":x, "data":records[x]} for x in sorted(records)]}
+    resp = client.patch("/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup", datastr)
+    if resp.status_code >= 400:
+        raise ServiceError("Failed to update mapping records: " + str(resp.json().get("message", resp.status_code)))
+    result = ("COMPLETED", "PLANNED")[plan]
+    report(result)
+    return result
+
+
+## longest (URL-encoded) records option sent in one request - the BIG-IP's httpd rejects request lines over 8 KB with a 414
+records_option_limit = 6144
+
+
+## build the tmsh records options (ex. records add { "svc:mac" { data "ip" } }) for an incremental data group update - the
+## records are split over as many options as needed to keep each request line under the limit
+def records_options(operation, records):
+    options = []
+    items = []
+    for x in sorted(records):
+        if operation == "delete":
+            item = "\"" + x + "\""
+        else:
+            item = "\"" + x + "\" { data \"" + records[x] + "\" }"
+        if items and len(requests.utils.quote("records " + operation + " { " + " ".join(items + [item]) + " }")) > records_option_limit:
+            options.append("records " + operation + " { " + " ".join(items) + " }")
+            items = []
+        items.append(item)
+    if items:
+        options.append("records " + operation + " { " + " ".join(items) + " }")
+    return options
+
+
+## compare mapping records - returns the (removed, changed, added) records
+def record_changes(current, records):
+    removed = dict((x, current[x]) for x in current if x not in records)
+    changed = dict((x, records[x]) for x in records if x in current and current[x] != records[x])
+    added = dict((x, records[x]) for x in records if x not in current)
+    return removed, changed, added
+
+
+## apply only the added, changed and removed mapping records - the other records (and the flows using them) are not touched.
+## The incremental requests are applied one after the other (the records options cannot be part of a transaction): if one
+## fails, the earlier ones stay applied, and running the tool again sends only the remaining differences. When more than
+## half of the records differ (ex. the first apply), the complete record list is sent instead, in one request
+def apply_records(client, current, records):
+    removed, changed, added = record_changes(current, records)
+
+    if not (removed or changed or added):
+        report("NO CHANGES")
+        return "NO CHANGES"
+
+    if len(removed) + len(changed) + len(added) > len(records) // 2:
+        report("Mapping changes: " + str(len(added)) + " add, " + str(len(changed)) + " modify, " + str(len(removed)) + " delete (complete record list)")
+        return replace_records(client, records)
+    report("Mapping changes: " + str(len(added)) + " add, " + str(len(changed)) + " modify, " + str(len(removed)) + " delete")
+
+    for operation, selected in [("delete", removed), ("modify", changed), ("add", added)]:
+        for option in records_options(operation, selected):
+            resp = client.patch("/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup?options=" + requests.utils.quote(option), {"name":"sslo-tier-datagroup"})
+            if resp.status_code >= 400:
+                raise ServiceError("Failed to update mapping records: " + str(resp.json().get("message", resp.status_code)))
+
+    result = ("COMPLETED", "PLANNED")[plan]
+    report(result)
+    return result
+
+
+
+## external data group files - uploads land in /var/config/rest/downloads. Two file names are used in turn, the new table is
+## uploaded completely before the data group is switched over to it (and reloaded) in a single change
+external_files = ["sslo-tier-datagroup-a.txt", "sslo-tier-datagroup-b.txt"]
+
+
+## external data group file content (ex. "svc:mac" := "ip",) - an empty table is a single empty line
+def external_file_content(records):
+    return "\n" if not records else "".join(["\"" + x + "\" := \"" + records[x] + "\",\n" for x in sorted(records)])
+
+
+## read the records of the external data group back from its source file, through the file transfer worker (the tool
+## uploads the files to /var/config/rest/downloads) - returns None when the file cannot be read
+def external_records(client, source_path):
+    if not source_path.startswith("file:/var/config/rest/downloads/"):
+        return None
+    content = client.download(source_path.rsplit("/", 1)[1])
+    if content is None:
+        return None
+    records = {}
+    for key, data in re.findall("\"([^\"]*)\"\\s*:=\\s*\"([^\"]*)\"", content):
+        records[key] = data
+    return records
+
+
+## publish the mapping as an external data group - the file is only rewritten when a record differs
+def apply_external_records(client, internal, external, current, records):
+    ## records that cannot be read back (ex. the source file was removed) are not taken as an empty table - the complete table
+    ## is uploaded again, which also restores a file the next run can read
+    unread = current is None
+    if unread:
+        report("The current records of the external data group could not be read back (" + external["sourcePath"] + ") - the complete table is uploaded")
+        current = {}
+    removed, changed, added = record_changes(current, records)
+
+    if "selfLink" in external and not (removed or changed or added or rebuild or unread):
+        report("NO CHANGES")
+        return "NO CHANGES"
+    report("Mapping changes: " + str(len(added)) + " add, " + str(len(changed)) + " modify, " + str(len(removed)) + " delete")
+
+    ## upload the new table under the file name not currently in use
+    filename = external_files[0]
+    if external.get("sourcePath", "").endswith("/" + external_files[0]):
+        filename = external_files[1]
+    client.upload(filename, external_file_content(records))
+    source = "file:/var/config/rest/downloads/" + filename
+
+    ## switch the existing data group over to the new file
+    if "selfLink" in external:
+        resp = client.patch("/mgmt/tm/sys/file/data-group/sslo-tier-datagroup", {"sourcePath":source})
+        if resp.status_code >= 400:
+            raise ServiceError("Failed to update mapping records: " + str(resp.json().get("message", resp.status_code)))
+        result = ("COMPLETED", "PLANNED")[plan]
+        report(result)
+        return result
+
+    ## first publish - the external data group replaces the internal one (same name, the library rule is unchanged)
+    tx = client.transaction()
+    if "selfLink" in internal:
+        client.delete("/mgmt/tm/ltm/data-group/internal/sslo-tier-datagroup", tx)
+    client.post("/mgmt/tm/sys/file/data-group", {"name":"sslo-tier-datagroup", "type":"string", "sourcePath":source}, tx)
+    client.post("/mgmt/tm/ltm/data-group/external", {"name":"sslo-tier-datagroup", "externalFileName":"/Common/sslo-tier-datagroup"}, tx)
+    return commit_records(client, tx)
+
+
+## commit a data group transaction
+def commit_records(client, tx):
+    result = client.commit(tx).json()
+    if result.get("state") not in ("COMPLETED", "PLANNED"):
+        raise ServiceError("Failed to update mapping records: " + str(result.get("message", result.get("state"))))
+    report(result["state"])
+    return result["state"]
+
+
+## service type handlers
+service_handlers = {
+    "layer3":service_objects,
+    "layer2":service_objects,
+    "http_explicit":service_objects,
+    "http_transparent":service_objects,
+    "icap":service_objects,
+    "mapping":service_mapping
+}
+
+
+## apply one loaded configuration - returns the result of the run
+def run_service(configs):
+    try:
+        type = configs["service"]["type"]
+    except (KeyError, TypeError):
+        raise ServiceError("Incorrect service type specified")
+    if type not in service_handlers:
+        raise ServiceError("Incorrect service type specified")
+    return service_handlers[type](configs)
+
+
+## unit-specific objects - non-floating self-IPs (traffic-group-local-only) are never config-synced between HA peers
+def local_object(key):
+    return key[0] == "/mgmt/tm/net/self" and not key[1].endswith("-float")
+
+
+## everything else is configured once and reaches the peer with the config-sync
+def shared_object(key):
+    return not local_object(key)
+
+
+## build the desired object set of a service on its unit, without applying it - returns (client, desired)
+def unit_objects(configs):
+    for key in ["host", "user", "password"]:
+        if key not in configs:
+            raise ServiceError("No " + key + " supplied in YAML")
+    if configs["service"].get("state", "present") == "absent":
+        return get_client(configs["host"], configs["user"], configs["password"]), []
+    collector.objects = []
+    try:
+        run_service(configs)
+        client, name, desired = collector.objects[0]
+    finally:
+        collector.objects = None
+    return client, desired
+
+
+## remove the unit-specific objects of a service that are no longer desired on a unit, or that must be replaced - done
+## before the shared objects they sit on (ex. a VLAN) are changed and synced
+def remove_local_objects(client, name, desired):
+    wanted = {}
+    for path, datastr in desired:
+        wanted[(path, datastr["name"])] = datastr
+
+    removes = []
+    for key in client.discover_service(name):
+        if not local_object(key):
+            continue
+        if key not in wanted:
+            removes.append(key)
+            continue
+        current = client.get(key[0] + "/" + key[1])
+        for prop in immutable_properties.get(key[0], []):
+            if prop in wanted[key] and not values_match(wanted[key][prop], lookup_property(current, prop)):
+                removes.append(key)
+                break
+
+    if not removes:
+        return "NO CHANGES"
+    tx = client.transaction()
+    submit_layers(client, delete_layers(removes), lambda key: client.delete(key[0] + "/" + key[1], tx))
+    response = client.commit(tx).json()
+    result = response.get("state")
+    if result == "COMPLETED":
+        client.discovery_update([], removes)
+    else:
+        client.discovery_forget()
+        if result != "PLANNED":
+            raise ServiceError("Failed to remove local service objects on " + client.host + ": " + str(response.get("message", result)))
+    return result
+
+
+## config-sync status of a unit (ex. In Sync, Changes Pending, Syncing, Standalone)
+def sync_status(client):
+    for entry in client.get("/mgmt/tm/cm/sync-status").get("entries", {}).values():
+        return entry["nestedStats"]["entries"]["status"]["description"]
+    return "unknown"
+
+
+## push a unit's configuration to its sync-failover device group and wait for the group to report it is in sync
+def config_sync(client, group, timeout=120):
+    resp = client.post("/mgmt/tm/cm", {"command":"run","utilCmdArgs":"config-sync to-group " + group})
+    if resp.status_code >= 400:
+        raise ServiceError("Config-sync to " + group + " failed: " + str(resp.json().get("message", resp.status_code)))
+    if plan:
+        return "PLANNED"
+    deadline = time.time() + timeout
+    while True:
+        status = sync_status(client)
+        if status == "In Sync":
+            return "COMPLETED"
+        if "Failure" in status or "Disconnected" in status or time.time() > deadline:
+            raise ServiceError("Config-sync to " + group + " did not complete: " + status)
+        time.sleep(0.5)
+
+
+## HA mode - apply a service to both units of an HA pair from the two units' configuration files. The shared objects are
+## applied once (on the unit of the first file) and config-synced to the peer, only the unit-specific self-IPs are applied
+## to each unit directly (in parallel)
+def run_ha(configs, peer_configs):
+    try:
+        name = configs["service"]["name"]
+        type = configs["service"]["type"]
+        peer_name = peer_configs["service"]["name"]
+        peer_type = peer_configs["service"]["type"]
+    except (KeyError, TypeError):
+        raise ServiceError("No service name or type supplied in YAML")
+    if type == "mapping" or peer_type == "mapping":
+        raise ServiceError("HA mode applies service files - the mapping data group is config-synced with the service objects")
+    if name != peer_name or type != peer_type:
+        raise ServiceError("The two configuration files must define the same service")
+    if configs["service"].get("state", "present") != peer_configs["service"].get("state", "present"):
+        raise ServiceError("The two configuration files must have the same state")
+    if configs.get("host") == peer_configs.get("host"):
+        raise ServiceError("The two configuration files must name the two different HA units")
+
+    ## build both object sets first - nothing is changed on either unit until both are known to be consistent. The data
+    ## group and library rule are only checked on the first unit, they reach the peer with the config-sync
+    if "host" in peer_configs and "user" in peer_configs and "password" in peer_configs:
+        get_client(peer_configs["host"], peer_configs["user"], peer_configs["password"]).prepared = True
+    client, desired = unit_objects(configs)
+    peer, peer_desired = unit_objects(peer_configs)
+
+    ## the shared objects must be identical, the self-IPs unique between the units
+    shared = {}
+    for path, datastr in desired:
+        if shared_object((path, datastr["name"])):
+            shared[(path, datastr["name"])] = json.dumps(datastr, sort_keys=True)
+    peer_shared = {}
+    for path, datastr in peer_desired:
+        if shared_object((path, datastr["name"])):
+            peer_shared[(path, datastr["name"])] = json.dumps(datastr, sort_keys=True)
+    for key in sorted(set(shared) | set(peer_shared)):
+        if shared.get(key) != peer_shared.get(key):
+            raise ServiceError("Object " + key[1] + " differs between the two configuration files (only the self-IPs may differ)")
+    addresses = set(datastr["address"] for path, datastr in desired if local_object((path, datastr["name"])))
+    for path, datastr in peer_desired:
+        if local_object((path, datastr["name"])) and datastr["address"] in addresses:
+            raise ServiceError("Self-IP " + datastr["address"] + " (" + datastr["name"] + ") is used on both units")
+
+    ## the two units' operations of a phase run in parallel (in order for plans)
+    units = [(client, desired), (peer, peer_desired)]
+
+    def on_units(operation):
+        if plan:
+            return [operation(x[0], x[1]) for x in units]
+        with ThreadPoolExecutor(max_workers=len(units)) as pool:
+            return list(pool.map(lambda x: operation(x[0], x[1]), units))
+
+    ## each phase is timed, and the next one only starts if every unit completed it
+    phases = []
+
+    def run_phase(title, operation):
+        report("#### " + title)
+        start = time.time()
+        results = operation()
+        phases.append((title, " / ".join(results), time.time() - start))
+        for x in results:
+            if x not in ("COMPLETED", "NO CHANGES", "PLANNED", "SKIPPED"):
+                raise ServiceError(title + " did not complete: " + x)
+        return results
+
+    def apply_shared():
+        if rebuild:
+            reset_objects(client, name)
+        return [apply_objects(client, name, [x for x in desired if shared_object((x[0], x[1]["name"]))], shared_object)]
+
+    def sync_shared():
+        group = client.facts()["sync_group"]
+        if group is None and plan:
+            group = "<sync-failover-group>"
+        if group is None:
+            raise ServiceError(client.host + " is not a member of a sync-failover device group")
+        if shared_results[0] == "NO CHANGES" and not rebuild and sync_status(client) == "In Sync":
+            report("NO CHANGES")
+            return ["SKIPPED"]
+        result = config_sync(client, group)
+        report(result)
+        return [result]
+
+    try:
+        run_phase("Removing unit self-IPs (" + client.host + ", " + peer.host + ")", lambda: on_units(lambda unit, objects: remove_local_objects(unit, name, [] if rebuild else objects)))
+        shared_results = run_phase("Applying shared objects (" + client.host + ")", apply_shared)
+        run_phase("Config-sync (" + client.host + " -> " + peer.host + ")", sync_shared)
+        run_phase("Applying unit self-IPs (" + client.host + ", " + peer.host + ")", lambda: on_units(lambda unit, objects: apply_objects(unit, name, objects, local_object)))
+    finally:
+        ## per-phase timing
+        print("\n%-70s %8s  %s" % ("phase", "seconds", "result"))
+        for title, result, seconds in phases:
+            if plan:
+                print("%-70s %8s  %s" % (title, "-", result))
+            else:
+                print("%-70s %8.2f  %s" % (title, seconds, result))
+
+    for title, result, seconds in phases:
+        if "COMPLETED" in result or "PLANNED" in result:
+            return "PLANNED" if plan else "COMPLETED"
+    return "NO CHANGES"
+
+
+## batch mode - load a set of configuration files, returns the loaded files [(filename, configs)] and the results of the
+## files that failed to load
+def load_files(filenames):
+    loaded = []
+    results = {}
+    for filename in filenames:
+        try:
+            with open(filename, "r") as file:
+                configs = safe_load(file)
+            configs["service"]["type"]
+        except:
+            results[filename] = ("-", "FAILED", 0, "Failed to open supplied file, or incorrect YAML format.")
+            continue
+        loaded.append((filename, configs))
+    return loaded, results
+
+
+## batch mode - apply loaded configuration files, services concurrently and mapping files last (in order). The result of
+## each file is recorded in results, progress (if given) is called after each file, label prefixes the file names of plans
+def apply_files(loaded, workers, results, progress=None, label=""):
+    services = []
+    mappings = []
+    names = {}
+    for filename, configs in loaded:
+        type = configs["service"]["type"]
+        if type == "mapping":
+            mappings.append((filename, configs))
+            continue
+        key = (configs.get("host"), configs["service"].get("name"))
+        if key in names:
+            results[filename] = (type, "FAILED", 0, "Service " + str(key[1]) + " is also defined in " + names[key])
+            continue
+        names[key] = filename
+        services.append((filename, configs))
+
+    ## run one file and record its result
+    def run_file(filename, configs):
+        ## plans have a header per file instead (they are rendered one file at a time)
+        if plan:
+            report("## " + label + filename)
+        else:
+            output.prefix = label + filename + ": "
+        start = time.time()
+        try:
+            result = run_service(configs)
+            results[filename] = (configs["service"]["type"], result, time.time() - start, "")
+        except ServiceError as e:
+            results[filename] = (configs["service"]["type"], "FAILED", time.time() - start, str(e))
+        except Exception as e:
+            results[filename] = (configs["service"]["type"], "FAILED", time.time() - start, repr(e))
+        output.prefix = ""
+        if progress is not None:
+            progress(filename, results[filename])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, configs in services:
+            executor.submit(run_file, filename, configs)
+
+    for filename, configs in mappings:
+        run_file(filename, configs)
+
+
+## batch mode - apply a set of configuration files in one run, returns the number of failed files
+def run_batch(filenames, workers):
+    loaded, results = load_files(filenames)
+    apply_files(loaded, workers, results)
+
+    ## per-file report
+    print("\n%-40s %-18s %-12s %8s  %s" % ("file", "type", "result", "seconds", "message"))
+    failed = 0
+    for filename in filenames:
+        type, result, seconds, message = results[filename]
+        if result == "FAILED":
+            failed += 1
+        if plan:
+            print("%-40s %-18s %-12s %8s  %s" % (filename, type, result, "-", message))
+        else:
+            print("%-40s %-18s %-12s %8.2f  %s" % (filename, type, result, seconds, message))
+    return failed
 
-except:
-    sys.exit()
 
+## merge override values into a configuration - dictionaries are merged key by key, anything else is replaced
+def merge_values(base, overrides):
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_values(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+## load an inventory file (fleet mode) - returns the targets [(name, top-level values, per-service overrides)]. Top-level
+## values (host, user, password) come from the target, or from defaults; services holds per service name the values merged
+## into the service section of its configuration (ex. the addressing of the target)
+def load_inventory(filename):
+    with open(filename, "r") as file:
+        inventory = safe_load(file)
+    if not isinstance(inventory, dict) or not isinstance(inventory.get("targets"), list) or not inventory["targets"]:
+        raise ServiceError("No targets supplied in the inventory file.")
+    defaults = inventory.get("defaults") or {}
+
+    targets = []
+    names = []
+    for x in inventory["targets"]:
+        if not isinstance(x, dict) or "host" not in x:
+            raise ServiceError("No host name supplied for an inventory target.")
+        name = str(x.get("name", x["host"]))
+        if name in names:
+            raise ServiceError("Inventory target " + name + " is defined more than once.")
+        names.append(name)
+        values = dict(defaults)
+        for key in x:
+            if key not in ("name", "services"):
+                values[key] = x[key]
+        services = x.get("services") or {}
+        if not isinstance(services, dict):
+            raise ServiceError("Incorrect services value for inventory target " + name + ".")
+        targets.append((name, values, services))
+    return targets
+
+
+## configuration of a file for one target of the inventory
+def target_configs(configs, target):
+    name, values, services = target
+    configs = merge_values(configs, values)
+    if configs["service"].get("name") in services:
+        configs["service"] = merge_values(configs["service"], services[configs["service"]["name"]])
+    return configs
+
+
+## value at a fraction of a sorted list (ex. 0.95 for the 95th percentile)
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+## fleet mode - apply the same configuration files to every target of an inventory. Targets are applied concurrently
+## (bounded by parallel), each with its own client and connection pool and the files of a target as in batch mode, so a
+## fleet roll-out takes about as long as the slowest target. Progress is reported as each file completes, followed by a
+## per-file report and a per-target latency summary. Returns the number of failed files
+def run_fleet(targets, filenames, workers, parallel):
+    loaded, failures = load_files(filenames)
+    total = len(targets) * len(filenames)
+    done = []
+    done_lock = threading.Lock()
+    results = {}
+    seconds = {}
+
+    ## live progress - one line per completed file
+    def progress(target, filename, result):
+        with done_lock:
+            done.append(filename)
+            count = len(done)
+        if plan:
+            report("[" + str(count) + "/" + str(total) + "] " + target + " " + filename + " " + result[1])
+        else:
+            report("[" + str(count) + "/" + str(total) + "] " + target + " " + filename + " " + result[1] + " (" + "%.2f" % result[2] + "s)")
+
+    def run_target(target):
+        start = time.time()
+        results[target[0]] = dict(failures)
+        for filename in failures:
+            progress(target[0], filename, failures[filename])
+        try:
+            apply_files([(filename, target_configs(configs, target)) for filename, configs in loaded], workers, results[target[0]], lambda filename, result: progress(target[0], filename, result), target[0] + " ")
+        except Exception as e:
+            for filename, configs in loaded:
+                if filename not in results[target[0]]:
+                    results[target[0]][filename] = (configs["service"]["type"], "FAILED", 0, repr(e))
+        seconds[target[0]] = time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        list(executor.map(run_target, targets))
+    elapsed = time.time() - start
+
+    ## per-file report
+    print("\n%-16s %-40s %-18s %-12s %8s  %s" % ("target", "file", "type", "result", "seconds", "message"))
+    failed = 0
+    for target in targets:
+        for filename in filenames:
+            type, result, took, message = results[target[0]][filename]
+            if result == "FAILED":
+                failed += 1
+            print("%-16s %-40s %-18s %-12s %8s  %s" % (target[0], filename, type, result, "-" if plan else "%.2f" % took, message))
+
+    ## per-target latency summary - requests sent to the target's BIG-IP and the time each one took
+    if plan:
+        return failed
+    print("\n%-16s %-32s %6s %7s %8s %9s %8s %8s %8s" % ("target", "host", "files", "failed", "seconds", "requests", "avg ms", "p95 ms", "max ms"))
+    for target in targets:
+        latencies = []
+        with clients_lock:
+            for key in clients:
+                if key[0] == target[1]["host"]:
+                    latencies += clients[key].latencies
+        latencies.sort()
+        failures_target = len([x for x in results[target[0]].values() if x[1] == "FAILED"])
+        if latencies:
+            print("%-16s %-32s %6d %7d %8.2f %9d %8.1f %8.1f %8.1f" % (target[0], target[1]["host"], len(filenames), failures_target, seconds[target[0]], len(latencies), sum(latencies) * 1000 / len(latencies), percentile(latencies, 0.95) * 1000, latencies[-1] * 1000))
+        else:
+            print("%-16s %-32s %6d %7d %8.2f %9d %8s %8s %8s" % (target[0], target[1]["host"], len(filenames), failures_target, seconds[target[0]], 0, "-", "-", "-"))
+    print("\n" + str(len(targets)) + " targets in %.2f seconds (slowest target %.2f seconds, %.2f seconds one target after the other)" % (elapsed, max(seconds.values()), sum(seconds.values())))
+    return failed
+
+
+## list the configuration files of a directory
+def directory_files(directory):
+    return [os.path.join(directory, x) for x in sorted(os.listdir(directory)) if x.endswith(".yml") or x.endswith(".yaml")]
+
+
+def main():
+    global rebuild
+    global plan
+    global state_cache
+
+    ## Test command-line arguments
+    try:
+        parser = ArgumentParser()
+        parser.add_argument("-f", "--file", dest="filenames", help="Input a configuration file (may be repeated)", metavar="FILE", action="append", default=[])
+        parser.add_argument("--peer-file", dest="peer_file", help="HA mode - configuration file of the HA peer of the --file unit (shared objects applied once and config-synced)", metavar="FILE")
+        parser.add_argument("-d", "--dir", dest="directory", help="Apply every configuration file (*.yml, *.yaml) in a directory", metavar="DIR")
+        parser.add_argument("--inventory", dest="inventory", help="Fleet mode - apply the configuration files to every target (BIG-IP) of an inventory file", metavar="FILE")
+        parser.add_argument("--targets", dest="targets", help="Number of inventory targets applied concurrently (default all)", type=int)
+        parser.add_argument("--workers", dest="workers", help="Number of services applied concurrently in batch mode (default 4)", type=int, default=4)
+        parser.add_argument("--rebuild", dest="rebuild", help="Delete and rebuild all service objects instead of applying only the differences", action="store_true")
+        parser.add_argument("--map-add", dest="map_add", help="Add or change one mapping record (service:srcmac=destip), BIG-IP taken from the mapping file", metavar="RECORD", action="append", default=[])
+        parser.add_argument("--map-remove", dest="map_remove", help="Remove one mapping record (service:srcmac), BIG-IP taken from the mapping file", metavar="RECORD", action="append", default=[])
+        parser.add_argument("--plan", dest="plan", help="Print the operations that would be sent, without contacting the BIG-IP", action="store_true")
+        parser.add_argument("--state", dest="state", help="Skip services unchanged since the last run, using a local state cache (default .sslo-tier-state.json next to the configuration files)", metavar="FILE", nargs="?", const="")
+        parser.add_argument("--timeout", dest="timeout", help="iControl REST read timeout in seconds (default 30)", type=float, default=30)
+        parser.add_argument("--connect-timeout", dest="connect_timeout", help="iControl REST connect timeout in seconds (default 10)", type=float, default=10)
+        parser.add_argument("--transport", dest="transport", help="iControl REST transport: requests (threads) or async (asyncio, aiohttp if installed) (default requests)", choices=["requests", "async"], default="requests")
+        parser.add_argument("--concurrency", dest="concurrency", help="Maximum iControl REST requests in flight per BIG-IP (default 8, or twice --workers)", type=int)
+        args = parser.parse_args()
+        rebuild = args.rebuild
+        plan = args.plan
+        client_options["timeout"] = args.timeout
+        client_options["connect_timeout"] = args.connect_timeout
+        client_options["transport"] = args.transport
+        client_options["concurrency"] = args.concurrency if args.concurrency is not None else max(client_options["concurrency"], args.workers * 2)
+        if client_options["concurrency"] < 1:
+            raise ValueError()
+        filenames = list(args.filenames)
+        if args.directory:
+            filenames += directory_files(args.directory)
+        for x in args.map_add:
+            key, destip = x.split("=")
+            mapping_edits["add"][key.strip()] = destip.strip()
+        mapping_edits["remove"] = [x.strip() for x in args.map_remove]
+        if not filenames or args.workers < 1:
+            raise ValueError()
+        if (args.map_add or args.map_remove) and (len(filenames) > 1 or args.directory):
+            raise ValueError()
+        if args.peer_file and (len(filenames) > 1 or args.directory or args.map_add or args.map_remove):
+            raise ValueError()
+        if args.inventory and (args.peer_file or args.map_add or args.map_remove):
+            raise ValueError()
+        if args.targets is not None and (not args.inventory or args.targets < 1):
+            raise ValueError()
+        ## plans always show the full build, so the state cache is not used for them
+        if args.state is not None and not plan:
+            state_file = args.state
+            if not state_file:
+                state_file = os.path.join(args.directory or os.path.dirname(os.path.abspath(filenames[0])), ".sslo-tier-state.json")
+            state_cache = StateCache(state_file)
+    except SystemExit:
+        raise
+    except:
+        error_exit("Incorrect arguments supplied.")
+
+    ## Fleet mode
+    if args.inventory:
+        try:
+            targets = load_inventory(args.inventory)
+        except ServiceError as e:
+            error_exit(str(e))
+        except:
+            error_exit("Failed to open supplied inventory file, or incorrect YAML format.")
+        ## plans are rendered one target and file at a time so the output is always in the same order
+        if plan:
+            args.workers = 1
+            args.targets = 1
+        if run_fleet(targets, filenames, args.workers, args.targets or len(targets)):
+            sys.exit(1)
+        return
+
+    ## Batch mode
+    if len(filenames) > 1 or args.directory:
+        ## plans are rendered one file at a time so the output is always in the same order
+        if plan:
+            args.workers = 1
+        if run_batch(filenames, args.workers):
+            sys.exit(1)
+        return
+
+    ## Test supplied YAML file for existence and structure
+    try:
+        with open(filenames[0], "r") as file:
+            configs = safe_load(file)
+    except:
+        error_exit("Failed to open supplied file, or incorrect YAML format.")
+
+    ## HA mode
+    if args.peer_file:
+        try:
+            with open(args.peer_file, "r") as file:
+                peer_configs = safe_load(file)
+        except:
+            error_exit("Failed to open supplied peer file, or incorrect YAML format.")
+        try:
+            report(run_ha(configs, peer_configs))
+        except ServiceError as e:
+            error_exit(str(e))
+        except:
+            sys.exit()
+        return
+
+    ## Single record edits need a mapping file
+    if (mapping_edits["add"] or mapping_edits["remove"]) and configs.get("service", {}).get("type") != "mapping":
+        error_exit("--map-add and --map-remove need a mapping file.")
+
+    ## Test YAML file for required content
+    try:
+        run_service(configs)
+    except ServiceError as e:
+        error_exit(str(e))
+    except:
+        sys.exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+#### SSL Orchestrator External Tiered Architecture - Benchmark
+#### Purpose: Measures the sslo-tier-tool against the local mock iControl REST server (mock_bigip.py). Every example service YAML
+####    is created, re-applied unchanged and deleted, and the mapping file is applied, each as a separate run of the tool. For
+####    every run the number of requests, the bytes exchanged and the wall time are reported per service type, so the effect
+####    of a change to the tool can be measured without a lab LTM. A layer 3 service "fe" is finally created and deleted
+####    next to a layer 2 service "fe-2", to check that neither touches the other's objects.
+####
+#### Instructions: python benchmark.py [--latency 20] [--dir ../example-yaml-sa] [--args "--rebuild"]
+
+
+## Imports
+from argparse import ArgumentParser
+from yaml import safe_load, dump
+import sys, os, time, shlex, tempfile, subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_bigip import start_server
+
+
+## repository root (this script lives in tools/)
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+## run the tool once on a configuration - returns the result line and the statistics of the run
+def run_tool(tool, mock, configs, extra, workdir):
+    filename = os.path.join(workdir, "service.yml")
+    with open(filename, "w") as file:
+        dump(configs, file)
+
+    before = mock.statistics()
+    start = time.time()
+    proc = subprocess.run([sys.executable, tool, "--file", filename] + extra, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    seconds = time.time() - start
+    after = mock.statistics()
+
+    lines = [x.strip() for x in proc.stdout.splitlines() if x.strip() and x.strip() != "Exiting"]
+    result = lines[-1] if lines else "exit " + str(proc.returncode)
+    return result, after["requests"] - before["requests"], after["received"] - before["received"], after["sent"] - before["sent"], seconds
+
+
+## benchmark one directory of example configurations
+def run_directory(tool, mock, url, directory, extra, workdir):
+    mock.reset()
+    services = []
+    mappings = []
+    for x in sorted(os.listdir(directory)):
+        if not (x.endswith(".yml") or x.endswith(".yaml")):
+            continue
+        with open(os.path.join(directory, x), "r") as file:
+            configs = safe_load(file)
+        configs["host"] = url
+        if configs["service"]["type"] == "mapping":
+            mappings.append((x, configs))
+        else:
+            services.append((x, configs))
+
+    ## create, re-apply unchanged, map, then delete
+    runs = []
+    for phase, state in [("create", "present"), ("reapply", "present")]:
+        for x, configs in services:
+            configs["service"]["state"] = state
+            runs.append((x, configs["service"]["type"], phase, configs))
+    for x, configs in mappings:
+        runs.append((x, "mapping", "apply", configs))
+    for x, configs in services:
+        configs = dict(configs, service=dict(configs["service"], state="absent"))
+        runs.append((x, configs["service"]["type"], "delete", configs))
+
+    rows = []
+    for x, type, phase, configs in runs:
+        result, requests, received, sent, seconds = run_tool(tool, mock, configs, extra, workdir)
+        rows.append((os.path.basename(directory), type, phase, requests, received, sent, seconds, result))
+        print("%-16s %-18s %-8s %9d %11d %11d %9.3f  %s" % rows[-1])
+    return rows
+
+
+## overlapping service names - a layer 3 service "fe" is created and deleted next to a layer 2 service "fe-2" (device "DEV"),
+## whose objects ("svc-fe-2-DEV-svc-in", ...) also start with "svc-fe-" and must be left alone
+def run_overlap(tool, mock, url, directory, extra, workdir):
+    mock.reset()
+    configs = {}
+    for type, name in [("layer2", "fe-2"), ("layer3", "fe")]:
+        for x in sorted(os.listdir(directory)):
+            if x.endswith(".yml") or x.endswith(".yaml"):
+                with open(os.path.join(directory, x), "r") as file:
+                    example = safe_load(file)
+                if example["service"]["type"] == type:
+                    break
+        example["host"] = url
+        example["service"]["name"] = name
+        if type == "layer2":
+            example["service"]["svc-side-net"] = [dict(example["service"]["svc-side-net"][0], name="DEV")]
+        configs[name] = example
+
+    ## the objects of "fe-2" on the mock
+    def objects():
+        return sorted((path, x) for path in mock.store for x in mock.store[path] if str(x).startswith("svc-fe-2-"))
+
+    rows = []
+    runs = [("fe-2", "present"), ("fe", "present"), ("fe", "absent"), ("fe-2", "absent")]
+    expected = None
+    for name, state in runs:
+        service = dict(configs[name], service=dict(configs[name]["service"], state=state))
+        result, requests, received, sent, seconds = run_tool(tool, mock, service, extra, workdir)
+        if name == "fe-2" and state == "present":
+            expected = objects()
+        elif name == "fe" and objects() != expected:
+            result = "FAILED (objects of fe-2 changed)"
+        rows.append(("overlap", service["service"]["type"], state == "present" and "create" or "delete", requests, received, sent, seconds, result))
+        print("%-16s %-18s %-8s %9d %11d %11d %9.3f  %s" % rows[-1])
+    return rows
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--dir", dest="directories", help="Directory of example configurations (may be repeated, default example-yaml-ha and example-yaml-sa)", metavar="DIR", action="append", default=[])
+    parser.add_argument("--latency", dest="latency", help="Delay added by the mock to every request in milliseconds (default 0)", type=float, default=0)
+    parser.add_argument("--tool", dest="tool", help="Path to the tool (default ../sslo-tier-tool.py)", default=os.path.join(root, "sslo-tier-tool.py"))
+    parser.add_argument("--args", dest="args", help="Extra command-line options passed to the tool (ex. \"--rebuild\")", default="")
+    args = parser.parse_args()
+
+    directories = args.directories or [os.path.join(root, "example-yaml-ha"), os.path.join(root, "example-yaml-sa")]
+    server, mock = start_server(0, args.latency / 1000.0)
+    url = "http://127.0.0.1:" + str(server.server_address[1])
+
+    print("%-16s %-18s %-8s %9s %11s %11s %9s  %s" % ("examples", "type", "phase", "requests", "bytes-sent", "bytes-recv", "seconds", "result"))
+    rows = []
+    workdir = tempfile.mkdtemp()
+    for directory in directories:
+        rows += run_directory(args.tool, mock, url, directory, shlex.split(args.args), workdir)
+    rows += run_overlap(args.tool, mock, url, directories[-1], shlex.split(args.args), workdir)
+    server.shutdown()
+
+    ## totals per phase
+    print("")
+    for phase in ["create", "reapply", "apply", "delete"]:
+        selected = [x for x in rows if x[2] == phase and x[0] != "overlap"]
+        if selected:
+            print("%-8s %5d runs %9d requests %11d bytes %9.3f seconds" % (phase, len(selected), sum(x[3] for x in selected), sum(x[4] + x[5] for x in selected), sum(x[6] for x in selected)))
+    failed = [x for x in rows if x[7] not in ("COMPLETED", "NO CHANGES")]
+    if failed:
+        print("\n" + str(len(failed)) + " run(s) did not complete")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
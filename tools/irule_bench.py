@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+#### SSL Orchestrator External Tiered Architecture - Library iRule micro-benchmark
+#### Purpose: Compares the per-flow cost of the standard and optimized sslo-tier-library lookups (get_data / get_data_fast)
+####    generated by the sslo-tier-tool. The library procs are taken from the tool itself and run in a local Tcl interpreter,
+####    with the BIG-IP commands they use (table, class, IP::*, TCP::*, LINK::lasthop, ROUTE::domain, findstr) replaced by
+####    cheap stand-ins of equal cost for both variants, so the difference measured is the Tcl work of the variants. Per-flow
+####    numbers on a BIG-IP are best confirmed with "timing on" in the service rules.
+####    Also compares the per-connection cost of the split session token variants of the HTTP services (split-token), and
+####    the per-request cost of the HTTP service rules on a keep-alive connection with per-request and per-connection session
+####    table keying (table-keying).
+####
+#### Instructions: python irule_bench.py [--iterations 100000] [--rounds 5]
+
+
+## Imports
+from argparse import ArgumentParser
+import sys, os, re, importlib.util
+
+try:
+    import tkinter
+except ImportError:
+    print("The benchmark needs the Python Tcl/Tk bindings (tkinter)")
+    sys.exit(1)
+
+
+## repository root (this script lives in tools/)
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+## stand-ins for the BIG-IP iRule commands used by the library
+tcl_stubs = """
+namespace eval IP { proc client_addr {} { return "10.1.10.50${::rd}" } ; proc local_addr {} { return "93.184.216.34${::rd}" } }
+namespace eval TCP { proc client_port {} { return 52416 } ; proc local_port {} { return 443 } }
+namespace eval LINK { proc lasthop {} { return "52:54:00:11:a4:42" } }
+namespace eval ROUTE { proc domain {} { return 10010 } }
+proc table { command args } { if { [lindex $args 0] eq "-subtable" } { set args [lassign $args - subtable] ; set key "${subtable},[lindex $args 0]" } else { set key [lindex $args 0] } ; if { $command eq "set" } { set ::table($key) [lindex $args 1] } else { if { [info exists ::table($key)] } { return $::table($key) } } }
+proc class { command key datagroup } { if { [info exists ::class($key)] } { return $::class($key) } }
+namespace eval HTTP { proc header { args } { if { [lindex $args 0] eq "insert" } { set ::header([lindex $args 1]) [lindex $args 2] } else { return $::header([lindex $args 0]) } } }
+proc call { proc args } { return [::$proc {*}$args] }
+proc node { address } { set ::node $address }
+proc findstr { string search skip terminator } { set i [string first $search $string] ; if { $i < 0 } { return "" } ; set string [string range $string [expr {$i + $skip}] end] ; set j [string first $terminator $string] ; if { $j < 0 } { return $string } ; return [string range $string 0 [expr {$j - 1}]] }
+set ::class(svc1:52:54:00:11:a4:42) 198.19.2.245
+set ::rd ""
+"""
+
+## per-flow return-side lookups - (case, route domain suffix, standard script, optimized script)
+cases = [
+    ("per-service subtable", "",
+     "::sslo-tier-library::get_data svc1 \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"",
+     "::sslo-tier-library::get_data_subtable svc1 \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\""),
+    ("layer 3 / http (no route domain)", "",
+     "::sslo-tier-library::get_data svc1 \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"",
+     "::sslo-tier-library::get_data_fast svc1 \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\""),
+    ("layer 2 (route domain)", "%10010",
+     "::sslo-tier-library::get_data svc1 \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"",
+     "::sslo-tier-library::get_data_fast svc1 [string map [list \"%[ROUTE::domain]\" \"\"] \"[IP::client_addr]:[TCP::client_port]:[IP::local_addr]:[TCP::local_port]\"]")
+]
+
+
+## load the tool as a module (library code and split session tokens)
+def load_tool(tool):
+    spec = importlib.util.spec_from_file_location("sslo_tier_tool", tool)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+## library code of the tool
+def library_code(module):
+    ## plain Tcl has no "contains" operator - use the equivalent string first
+    return re.sub(r"\$\{(\w+)\} contains \"([^\"]*)\"", r'[string first "\2" ${\1}] >= 0', module.sslo_library_code)
+
+
+## time a script - returns microseconds per iteration
+def measure(tcl, script, iterations):
+    return float(tcl.eval("time {" + script + "} " + str(iterations)).split()[0])
+
+
+## body of an HTTP_REQUEST service rule generated by the tool (run as a plain script, the connection variables are globals)
+def http_rule(module, event, keying):
+    ctx = {"name":"svc1", "set_proc":"set_data", "get_proc":"get_data", "table_args":"", "split_token":"random", "table_keying":keying, "table_refresh":5}
+    return module.rule_code(ctx, event, "http")[len("when HTTP_REQUEST {"):-1]
+
+
+## warm up, then measure two scripts in alternating rounds and keep the best round of each (least disturbed)
+def compare(tcl, before_script, after_script, iterations, rounds):
+    measure(tcl, before_script, 1000)
+    measure(tcl, after_script, 1000)
+    before = []
+    after = []
+    for x in range(rounds):
+        before.append(measure(tcl, before_script, iterations))
+        after.append(measure(tcl, after_script, iterations))
+    return min(before), min(after)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--iterations", dest="iterations", help="Flows per measurement round (default 100000)", type=int, default=100000)
+    parser.add_argument("--rounds", dest="rounds", help="Measurement rounds per variant (default 5)", type=int, default=5)
+    parser.add_argument("--tool", dest="tool", help="Path to the tool (default ../sslo-tier-tool.py)", default=os.path.join(root, "sslo-tier-tool.py"))
+    args = parser.parse_args()
+
+    tcl = tkinter.Tcl()
+    tcl.eval(tcl_stubs)
+    module = load_tool(args.tool)
+    tcl.eval("namespace eval sslo-tier-library {" + library_code(module) + "}")
+
+    print("%-36s %18s %18s %8s" % ("case", "standard us/flow", "optimized us/flow", "saving"))
+    for case, rd, standard, optimized in cases:
+        tcl.eval("set ::rd \"" + rd + "\"")
+
+        ## the flow is recorded on the sslo-side (no route domain)
+        tcl.eval("::sslo-tier-library::set_data svc1 \"10.1.10.50:52416:93.184.216.34:443\"")
+        tcl.eval("::sslo-tier-library::set_data_subtable svc1 \"10.1.10.50:52416:93.184.216.34:443\" 30 indefinite")
+
+        ## both variants must find the flow
+        if tcl.eval(standard) != tcl.eval(optimized) or tcl.eval(optimized) == "":
+            print(case + ": standard and optimized lookups disagree")
+            sys.exit(1)
+
+        before, after = compare(tcl, standard, optimized, args.iterations, args.rounds)
+        print("%-36s %18.3f %18.3f %7.0f%%" % (case, before, after, (before - after) * 100 / before))
+
+    ## split session token of each new connection - the default (random) against the cheaper variants
+    print("")
+    print("%-36s %18s %18s %8s" % ("split-token (per connection)", "random us/conn", "variant us/conn", "saving"))
+    tcl.eval("set ::rd \"\"")
+    random_token = "set randstr " + module.split_tokens["random"]
+    for variant in sorted(module.split_tokens):
+        if variant != "random":
+            before, after = compare(tcl, random_token, "set randstr " + module.split_tokens[variant], args.iterations, args.rounds)
+            print("%-36s %18.3f %18.3f %7.0f%%" % (variant, before, after, (before - after) * 100 / before))
+
+    ## requests on a keep-alive connection (sslo-side and svc-side rules) - the token and any connection-scoped values are
+    ## made by the warm-up, so the rounds measure the steady state
+    print("")
+    print("%-36s %18s %18s %8s" % ("table-keying (per keep-alive request)", "request us/req", "connection us/req", "saving"))
+    scripts = {}
+    for keying in ["request", "connection"]:
+        scripts[keying] = http_rule(module, "set", keying) + " ; " + http_rule(module, "get", keying)
+        tcl.eval("unset -nocomplain randstr recorded sslo_token sslo_node ::node ; " + scripts[keying])
+        if tcl.eval("set ::node") != "198.19.2.245":
+            print(keying + " keying: the svc-side rule did not find the flow")
+            sys.exit(1)
+    before, after = compare(tcl, scripts["request"], scripts["connection"], args.iterations, args.rounds)
+    print("%-36s %18.3f %18.3f %7.0f%%" % ("http (standard library)", before, after, (before - after) * 100 / before))
+
+
+if __name__ == "__main__":
+    main()
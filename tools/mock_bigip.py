@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+#### SSL Orchestrator External Tiered Architecture - Mock iControl REST server
+#### Purpose: A local stand-in for the BIG-IP iControl REST API, used to measure and test the sslo-tier-tool without a lab LTM.
+####    Emulates the /mgmt/tm collections used by the tool (create, read, modify, delete, $select/$filter/$top/$skip queries),
+####    transactions (X-F5-REST-Coordination-Id), token login, object generations and the /mgmt/tm/cm device facts. Empty
+####    string properties are left out of the responses, as the BIG-IP does. Objects
+####    referring to missing svc-* objects, and deletes of objects still in use, are rejected the way the BIG-IP rejects them,
+####    so the order of the operations the tool sends is checked as well. Request lines over 8 KB are refused (414). Pool members create their nodes, and a member cannot
+####    use an address taken by a node of another name. An optional per-request latency simulates a remote management plane.
+####    With --ha a second (standby) unit is started on the next port, the two form a sync-failover device group and a
+####    config-sync copies everything but the non-floating self-IPs to the peer.
+####
+#### Instructions: python mock_bigip.py --port 8100 --latency 20 [--ha]
+####    then point the "host" value of a service YAML at http://127.0.0.1:8100 (and the HA peer's at http://127.0.0.1:8101)
+
+
+## Imports
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+import sys, json, re, time, copy, threading
+
+
+## longest request line accepted - the BIG-IP's httpd answers 414 beyond 8 KB
+request_line_limit = 8192
+
+## collections known to the mock - others are created on first POST
+known_collections = [
+    "/mgmt/tm/net/vlan",
+    "/mgmt/tm/net/route-domain",
+    "/mgmt/tm/net/self",
+    "/mgmt/tm/ltm/monitor/gateway-icmp",
+    "/mgmt/tm/ltm/monitor/tcp-half-open",
+    "/mgmt/tm/ltm/monitor/tcp",
+    "/mgmt/tm/ltm/monitor/http",
+    "/mgmt/tm/ltm/monitor/inband",
+    "/mgmt/tm/ltm/pool",
+    "/mgmt/tm/ltm/snatpool",
+    "/mgmt/tm/ltm/rule",
+    "/mgmt/tm/ltm/virtual",
+    "/mgmt/tm/ltm/virtual-address",
+    "/mgmt/tm/ltm/node",
+    "/mgmt/tm/ltm/data-group/internal",
+    "/mgmt/tm/ltm/data-group/external",
+    "/mgmt/tm/sys/file/data-group"
+]
+
+## object properties that point at other objects - only references to svc-* objects (the ones the tool builds) are checked,
+## built-in objects (ex. /Common/tcp, /Common/gateway_icmp) are assumed to exist. A monitor may be of any monitor type
+reference_properties = {
+    "vlan":"/mgmt/tm/net/vlan",
+    "vlans":"/mgmt/tm/net/vlan",
+    "monitor":["/mgmt/tm/ltm/monitor/gateway-icmp", "/mgmt/tm/ltm/monitor/tcp-half-open", "/mgmt/tm/ltm/monitor/tcp", "/mgmt/tm/ltm/monitor/http", "/mgmt/tm/ltm/monitor/inband"],
+    "pool":"/mgmt/tm/ltm/pool",
+    "rules":"/mgmt/tm/ltm/rule"
+}
+
+
+## error raised by an operation - carries the HTTP status and BIG-IP style message
+class MockError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+## raw (not JSON) response body - a chunk of a downloaded file with its Content-Range
+class FileChunk(object):
+    def __init__(self, content, content_range):
+        self.content = content
+        self.content_range = content_range
+
+
+## in-memory BIG-IP configuration and request statistics
+class MockBigIP(object):
+
+    def __init__(self, latency=0.0, failover="ACTIVE", device="bigip1.mock"):
+        self.latency = latency
+        self.failover = failover
+        self.device = device
+        ## HA peer (another MockBigIP) - None for a standalone unit
+        self.peer = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    ## clear the configuration and the statistics
+    def reset(self):
+        with self.lock:
+            self.store = {}
+            for path in known_collections:
+                self.store[path] = {}
+            self.transactions = {}
+            self.files = {}
+            self.next_tx = 1
+            ## configuration generation - every created or modified object carries the generation of its last change
+            self.generation = 1
+            self.sync_pending = False
+            self.stats = {"requests":0, "sent":0, "received":0, "methods":{}}
+
+    ## snapshot of the statistics
+    def statistics(self):
+        with self.lock:
+            return copy.deepcopy(self.stats)
+
+    ## split a path into (collection, object name) - name is None for a collection
+    def locate(self, store, path):
+        if path in store:
+            return path, None
+        collection, name = path.rsplit("/", 1)
+        if collection in store:
+            return collection, unquote(name).replace("~Common~", "")
+        raise MockError(404, "The requested path (" + path + ") was not found.")
+
+    ## list the svc-* objects an object refers to
+    def references(self, store, datastr):
+        refs = []
+        for key in reference_properties:
+            if key in datastr:
+                values = datastr[key] if isinstance(datastr[key], list) else [datastr[key]]
+                for x in values:
+                    for token in str(x).split():
+                        token = token.replace("/Common/", "")
+                        if token.startswith("svc-"):
+                            collection = reference_properties[key]
+                            if isinstance(collection, list):
+                                collection = ([y for y in collection if token in store.get(y, {})] + collection)[0]
+                            refs.append((collection, token))
+        if isinstance(datastr.get("sourceAddressTranslation"), dict) and "pool" in datastr["sourceAddressTranslation"]:
+            token = str(datastr["sourceAddressTranslation"]["pool"]).replace("/Common/", "")
+            if token.startswith("svc-"):
+                refs.append(("/mgmt/tm/ltm/snatpool", token))
+        return refs
+
+    ## check that everything an object refers to exists (including a route domain used through an address suffix, and the
+    ## uploaded file a data group file is imported from)
+    def check_references(self, store, datastr):
+        if "sourcePath" in datastr and datastr["sourcePath"].rsplit("/", 1)[1] not in self.files:
+            raise MockError(400, "01070712:3: File (" + datastr["sourcePath"] + ") does not exist.")
+        for collection, name in self.references(store, datastr):
+            if name not in store.get(collection, {}):
+                raise MockError(400, "01020036:3: The requested object (/Common/" + name + ") was not found.")
+        for prop in ["address", "source", "destination"]:
+            if "%" in str(datastr.get(prop, "")):
+                rd = re.match("[0-9]+", str(datastr[prop]).split("%")[1]).group(0)
+                if rd != "0" and rd not in [str(x.get("id")) for x in store["/mgmt/tm/net/route-domain"].values()]:
+                    raise MockError(400, "01070712:3: Route domain (" + rd + ") does not exist.")
+
+    ## pool members use nodes - a node is created for every member without one, an address already taken by a node of
+    ## another name is rejected
+    def member_nodes(self, store, datastr):
+        nodes = store["/mgmt/tm/ltm/node"]
+        for member in datastr.get("members", []):
+            name = str(member["name"]).replace("/Common/", "").rsplit(":", 1)[0]
+            address = str(member.get("address", name))
+            for other in nodes.values():
+                if other.get("address") == address and other["name"] != name:
+                    raise MockError(400, "01070734:3: Configuration error: The requested node address (" + address + ") is already used by node (/Common/" + other["name"] + ").")
+            if name not in nodes:
+                self.generation += 1
+                nodes[name] = {"name":name, "address":address, "generation":self.generation, "kind":"tm:ltm:node:nodestate", "partition":"Common", "fullPath":"/Common/" + name}
+
+    ## pools with a member using a node
+    def node_users(self, store, name):
+        users = []
+        for pool in store["/mgmt/tm/ltm/pool"].values():
+            for member in pool.get("members", []):
+                if str(member["name"]).replace("/Common/", "").rsplit(":", 1)[0] == name:
+                    users.append(pool["name"])
+        return users
+
+    ## apply one configuration change to a store
+    def apply(self, store, method, path, datastr):
+        if method == "POST":
+            if path not in store:
+                store[path] = {}
+            if "name" not in datastr:
+                raise MockError(400, "Missing object name.")
+            name = datastr["name"]
+            if name in store[path]:
+                raise MockError(409, "01020066:3: The requested object (/Common/" + name + ") already exists in partition Common.")
+            self.check_references(store, datastr)
+            if path == "/mgmt/tm/ltm/pool":
+                self.member_nodes(store, datastr)
+            obj = dict(datastr)
+            self.generation += 1
+            obj.update({"generation":self.generation, "kind":"tm:" + path[len("/mgmt/tm/"):].replace("/", ":") + ":state", "partition":"Common", "fullPath":"/Common/" + name, "selfLink":"https://localhost" + path + "/~Common~" + name})
+            store[path][name] = obj
+            return obj
+
+        collection, name = self.locate(store, path)
+        if name is None:
+            raise MockError(405, "Method not allowed on a collection.")
+        if name not in store[collection]:
+            raise MockError(404, "01020036:3: The requested object (/Common/" + name + ") was not found.")
+
+        if method in ("PATCH", "PUT"):
+            obj = dict(store[collection][name])
+            obj.update(datastr)
+            self.generation += 1
+            obj["generation"] = self.generation
+            self.check_references(store, obj)
+            if collection == "/mgmt/tm/ltm/pool":
+                self.member_nodes(store, obj)
+            store[collection][name] = obj
+            return obj
+
+        if method == "DELETE":
+            if collection == "/mgmt/tm/ltm/node" and self.node_users(store, name):
+                raise MockError(400, "01070110:3: Node address (/Common/" + name + ") is referenced by a member of pool (/Common/" + self.node_users(store, name)[0] + ").")
+            for other in store:
+                for objname in store[other]:
+                    if (collection, name) in self.references(store, store[other][objname]):
+                        raise MockError(400, "01070265:3: The object (/Common/" + name + ") cannot be deleted because it is in use by (/Common/" + objname + ").")
+            del store[collection][name]
+            return {}
+
+        raise MockError(405, "Method not allowed.")
+
+    ## test if a change is config-synced to the peer - non-floating self-IPs stay on the unit
+    def synced(self, store, method, path, datastr):
+        if not path.startswith("/mgmt/tm/net/self"):
+            return True
+        obj = datastr
+        if method != "POST":
+            collection, name = self.locate(store, path)
+            obj = dict(store[collection].get(name, {}), **datastr)
+        return not str(obj.get("trafficGroup", "")).endswith("traffic-group-local-only")
+
+    ## config-sync to the peer - the peer's configuration is replaced by this unit's, apart from the peer's own self-IPs
+    def config_sync(self):
+        if self.peer is None:
+            raise MockError(400, "01070710:3: This device is not a member of a sync-failover device group.")
+        with self.peer.lock:
+            for collection in self.store:
+                kept = dict((name, obj) for name, obj in self.peer.store.get(collection, {}).items() if not self.synced(self.peer.store, "POST", collection, obj))
+                copied = dict((name, copy.deepcopy(obj)) for name, obj in self.store[collection].items() if self.synced(self.store, "POST", collection, obj))
+                copied.update(kept)
+                self.peer.store[collection] = copied
+            self.peer.files.update(self.files)
+            self.peer.sync_pending = False
+        self.sync_pending = False
+
+    ## incremental data group record update (tmsh style ?options=records add|modify|delete { ... })
+    def apply_records(self, store, path, options):
+        collection, name = self.locate(store, path)
+        if name is None or name not in store[collection]:
+            raise MockError(404, "01020036:3: The requested data group (/Common/" + str(name) + ") was not found.")
+        match = re.match("records (add|modify|delete) {(.*)}$", options.strip())
+        if not match:
+            raise MockError(400, "Invalid options (" + options + ").")
+        operation = match.group(1)
+        obj = dict(store[collection][name])
+        records = dict((x["name"], x.get("data", "")) for x in obj.get("records", []))
+        if operation == "delete":
+            for key in re.findall("\"([^\"]*)\"", match.group(2)):
+                if key not in records:
+                    raise MockError(400, "01020036:3: The requested record (" + key + ") was not found.")
+                del records[key]
+        else:
+            for key, data in re.findall("\"([^\"]*)\" { data \"([^\"]*)\" }", match.group(2)):
+                if operation == "add" and key in records:
+                    raise MockError(409, "01020066:3: The requested record (" + key + ") already exists.")
+                if operation == "modify" and key not in records:
+                    raise MockError(400, "01020036:3: The requested record (" + key + ") was not found.")
+                records[key] = data
+        obj["records"] = [{"name":x, "data":records[x]} for x in sorted(records)]
+        self.generation += 1
+        obj["generation"] = self.generation
+        store[collection][name] = obj
+        return obj
+
+    ## read an object or a (queried) collection
+    def read(self, path, query):
+        if path == "/mgmt/tm/cm/failover-status":
+            return {"entries":{"https://localhost/mgmt/tm/cm/failover-status/0":{"nestedStats":{"entries":{"status":{"description":self.failover}}}}}}
+        if path == "/mgmt/tm/cm/device":
+            return {"items":[{"name":self.device, "selfDevice":"true", "failoverState":self.failover.lower()}]}
+        if path == "/mgmt/tm/cm/device-group":
+            if self.peer is not None:
+                return {"items":[{"name":"device_trust_group", "type":"sync-only"}, {"name":"sslo-failover-group", "type":"sync-failover"}]}
+            return {"items":[{"name":"device_trust_group", "type":"sync-only"}]}
+        if path == "/mgmt/tm/cm/traffic-group/stats":
+            return {"entries":{"https://localhost/mgmt/tm/cm/traffic-group/~Common~traffic-group-1:~Common~" + self.device + "/stats":{"nestedStats":{"entries":{"deviceName":{"description":"/Common/" + self.device}, "failoverState":{"description":self.failover.lower()}, "trafficGroup":{"description":"/Common/traffic-group-1"}}}}}}
+        if path == "/mgmt/tm/cm/sync-status":
+            status = "Standalone" if self.peer is None else ("Changes Pending" if self.sync_pending else "In Sync")
+            return {"entries":{"https://localhost/mgmt/tm/cm/sync-status/0":{"nestedStats":{"entries":{"status":{"description":status}}}}}}
+
+        collection, name = self.locate(self.store, path)
+        if name is not None:
+            if name not in self.store[collection]:
+                raise MockError(404, "01020036:3: The requested object (/Common/" + name + ") was not found.")
+            return self.shown(self.store[collection][name])
+
+        items = [self.shown(self.store[collection][x]) for x in sorted(self.store[collection])]
+        if "$filter" in query:
+            partition = query["$filter"][0].split(" eq ")[-1].strip()
+            items = [x for x in items if x.get("partition") == partition]
+        skip = int(query.get("$skip", ["0"])[0])
+        top = int(query.get("$top", [str(len(items))])[0])
+        items = items[skip:skip + top]
+        if "$select" in query:
+            fields = query["$select"][0].split(",")
+            ## subcollections (ex. membersReference) are returned expanded
+            items = [dict([(k, x[k]) for k in fields if k in x] + [(k, {"items":x[k[:-9]]}) for k in fields if k.endswith("Reference") and k[:-9] in x]) for x in items]
+        return {"kind":"tm:collectionstate", "items":items}
+
+    ## an object as the BIG-IP returns it - empty string properties (ex. a monitor's send and recv) are left out
+    @staticmethod
+    def shown(obj):
+        return dict((k, v) for k, v in obj.items() if v != "")
+
+    ## handle one request - returns (status, body)
+    def handle(self, method, target, body, headers):
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = urlsplit(target)
+        path = parts.path
+        query = parse_qs(parts.query)
+        upload = path.startswith("/mgmt/shared/file-transfer/uploads/")
+        datastr = json.loads(body) if body and not upload else {}
+        tx = headers.get("X-F5-REST-Coordination-Id")
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["received"] += len(target) + len(body)
+            self.stats["methods"][method] = self.stats["methods"].get(method, 0) + 1
+            try:
+                if len(method) + len(target) + 10 > request_line_limit:
+                    raise MockError(414, "Request-URI Too Long")
+
+                ## token login
+                if path == "/mgmt/shared/authn/login":
+                    return 200, {"token":{"token":"mock-token-" + str(self.next_tx), "timeout":1200}}
+
+                ## file upload to /var/config/rest/downloads (Content-Range: start-end/size)
+                if upload and method == "POST":
+                    filename = path.rsplit("/", 1)[1]
+                    start = int(headers.get("Content-Range", "0-0/0").split("-")[0])
+                    self.files[filename] = self.files.get(filename, "")[:start] + body
+                    return 200, {"remainingByteCount":0, "usedChunks":{}, "totalByteCount":len(self.files[filename]), "localFilePath":"/var/config/rest/downloads/" + filename}
+
+                ## file download from /var/config/rest/downloads (Content-Range: start-end/size) - a range past the end of the
+                ## file is refused, with the size of the file in the Content-Range of the response
+                if path.startswith("/mgmt/shared/file-transfer/downloads/") and method == "GET":
+                    filename = path.rsplit("/", 1)[1]
+                    if filename not in self.files:
+                        raise MockError(404, "File " + filename + " was not found.")
+                    data = self.files[filename].encode("utf-8")
+                    match = re.match("(\\d+)-(\\d+)/", headers.get("Content-Range", ""))
+                    start, end = (int(match.group(1)), int(match.group(2))) if match else (0, len(data) - 1)
+                    if start > end or end >= len(data):
+                        return 400, FileChunk(b"", "0-" + str(len(data) - 1) + "/" + str(len(data)))
+                    return 200, FileChunk(data[start:end + 1], str(start) + "-" + str(end) + "/" + str(len(data)))
+
+                ## start a transaction
+                if path == "/mgmt/tm/transaction" and method == "POST":
+                    txid = self.next_tx
+                    self.next_tx += 1
+                    self.transactions[txid] = []
+                    return 200, {"transId":txid, "state":"STARTED"}
+
+                ## commit a transaction - all commands are applied in order to a copy, nothing changes if any command fails
+                if path.startswith("/mgmt/tm/transaction/") and method == "PATCH":
+                    txid = int(path.rsplit("/", 1)[1])
+                    if txid not in self.transactions:
+                        raise MockError(404, "Transaction " + str(txid) + " was not found.")
+                    commands = self.transactions.pop(txid)
+                    store = copy.deepcopy(self.store)
+                    for x in commands:
+                        if self.synced(store, x[0], x[1], x[2]):
+                            self.sync_pending = True
+                        self.apply(store, x[0], x[1], x[2])
+                    self.store = store
+                    return 200, {"transId":txid, "state":"COMPLETED"}
+
+                ## queue a command in a transaction
+                if tx is not None and method != "GET":
+                    txid = int(tx)
+                    if txid not in self.transactions:
+                        raise MockError(404, "Transaction " + str(txid) + " was not found.")
+                    self.transactions[txid].append((method, path, datastr))
+                    return 200, {"transId":txid, "evalOrder":len(self.transactions[txid])}
+
+                ## config-sync (tmsh run cm config-sync to-group <group>) - completes immediately
+                if path == "/mgmt/tm/cm" and method == "POST":
+                    if not re.match("config-sync to-group \\S+$", datastr.get("utilCmdArgs", "")):
+                        raise MockError(400, "Unsupported command (" + datastr.get("utilCmdArgs", "") + ").")
+                    self.config_sync()
+                    return 200, {"kind":"tm:cm:runstate", "command":"run", "utilCmdArgs":datastr["utilCmdArgs"]}
+
+                if method == "GET":
+                    return 200, self.read(path, query)
+                if self.synced(self.store, method, path, datastr):
+                    self.sync_pending = True
+                if method == "PATCH" and "options" in query:
+                    return 200, self.apply_records(self.store, path, query["options"][0])
+                return 200, self.apply(self.store, method, path, datastr)
+
+            except MockError as e:
+                return e.status, {"code":e.status, "message":e.message, "errorStack":[]}
+
+
+## HTTP front end (keep-alive, JSON bodies)
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        status, datastr = self.server.mock.handle(self.command, self.path, body, self.headers)
+        if isinstance(datastr, FileChunk):
+            payload = datastr.content
+        else:
+            payload = json.dumps(datastr).encode("utf-8")
+        with self.server.mock.lock:
+            self.server.mock.stats["sent"] += len(payload)
+        self.send_response(status)
+        if isinstance(datastr, FileChunk):
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Range", datastr.content_range)
+        else:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+## start a mock server in a background thread - returns (server, mock), the server listens on server.server_address
+def start_server(port=0, latency=0.0, failover="ACTIVE", device="bigip1.mock"):
+    mock = MockBigIP(latency, failover, device)
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, mock
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--port", dest="port", help="Port to listen on (default 8100)", type=int, default=8100)
+    parser.add_argument("--latency", dest="latency", help="Delay added to every request in milliseconds (default 0)", type=float, default=0)
+    parser.add_argument("--failover", dest="failover", help="Failover status reported by /mgmt/tm/cm/failover-status (default ACTIVE)", default="ACTIVE")
+    parser.add_argument("--ha", dest="ha", help="Also start a standby HA peer on the next port (sync-failover device group)", action="store_true")
+    args = parser.parse_args()
+
+    server, mock = start_server(args.port, args.latency / 1000.0, args.failover)
+    print("Mock iControl REST server listening on http://127.0.0.1:" + str(server.server_address[1]))
+    if args.ha:
+        peer_server, peer = start_server(server.server_address[1] + 1, args.latency / 1000.0, "STANDBY", "bigip2.mock")
+        mock.peer = peer
+        peer.peer = mock
+        print("HA peer listening on http://127.0.0.1:" + str(peer_server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stats = mock.statistics()
+        print("\n" + str(stats["requests"]) + " requests, " + str(stats["received"]) + " bytes received, " + str(stats["sent"]) + " bytes sent")
+
+
+if __name__ == "__main__":
+    main()